@@ -0,0 +1,370 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+"""
+	Benchmarks the DropboxFuse operations against a local fake Dropbox
+	server, without mounting, and writes the results as json
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import fuse
+from dropbox_logger import DropboxLogManager
+from dropbox_client import DropboxClient
+from dropbox_cache import CacheManager, MetadataCache, MetadataCacheEntry, DataCache
+from dropbox_download_manager import DropboxDownloadManager
+from dropbox_writeback import DropboxWriteBack
+from dropbox_fuse import DropboxFuse
+from dropbox_fake_server import FakeDropboxServer
+
+MB = 1024 * 1024
+
+
+def summary(samples):
+    # latencies in ms
+    samples = sorted(samples)
+    if not samples:
+        return dict()
+
+    def percentile(p):
+        return samples[min(len(samples) - 1, int(len(samples) * p))] * 1000
+    return dict(count=len(samples),
+                mean=sum(samples) * 1000 / len(samples),
+                p50=percentile(0.5),
+                p95=percentile(0.95),
+                p99=percentile(0.99),
+                max=samples[-1] * 1000)
+
+
+def deep_size(roots):
+    # bytes held by the containers, strings, numbers and cache
+    # entries reachable from roots, each object counted once
+    seen = set()
+    size = 0
+    stack = list(roots)
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, dict):
+            stack.extend(obj.iterkeys())
+            stack.extend(obj.itervalues())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        elif isinstance(obj, MetadataCacheEntry):
+            if hasattr(obj, '__dict__'):
+                stack.append(obj.__dict__)
+            for cls in type(obj).__mro__:
+                for name in getattr(cls, '__slots__', ()):
+                    if name not in ('client', '__weakref__') and hasattr(obj, name):
+                        stack.append(getattr(obj, name))
+        elif not isinstance(obj, (basestring, int, long, float, bool, type(None))):
+            # clients, loggers and uploaders are shared or short-lived
+            continue
+        size += sys.getsizeof(obj)
+    return size
+
+
+def throughput(size, seconds, samples):
+    return dict(bytes=size, seconds=seconds, mb_per_s=size / float(MB) / seconds if seconds else None,
+                latency_ms=summary(samples))
+
+
+class Benchmark(object):
+    def __init__(self, options):
+        self.options = options
+        self.workdir = tempfile.mkdtemp(prefix='dropboxfuse-bench-')
+        self.server = FakeDropboxServer(latency=options.latency / 1000.0, bandwidth=options.bandwidth * MB)
+        self.data = os.urandom(options.file_size * MB)
+        self.server.tree.put_file('/bench/sequential.bin', self.data)
+        self.server.tree.put_file('/bench/random.bin', self.data)
+        for d in xrange(options.dirs):
+            for f in xrange(options.files):
+                self.server.tree.put_file('/tree/d%04d/f%05d' % (d, f), 'x' * 100)
+        for s in xrange(options.streams):
+            self.server.tree.put_file('/streams/f%05d' % s, self.data[:options.stream_file_size * 1024])
+        self.large = None
+        if options.large_file_size > 0:
+            copies = (options.large_file_size + options.file_size - 1) // options.file_size
+            self.large = (self.data * copies)[:options.large_file_size * MB]
+            self.server.tree.put_file('/bench/large.bin', self.large)
+        self.server.start()
+        self.fs = None
+        self.writeback = None
+        self.shared_dir = None
+
+    def mount(self):
+        # everything the mount sets up before serving requests
+        options = self.options
+        config = os.path.join(self.workdir, 'config')
+        with open(config, 'wb') as fp:
+            json.dump(dict(app_key='key', app_secret='secret', access_token='token', user_id='0'), fp)
+
+        started = time.time()
+        client = self.server.attach(DropboxClient(config))
+        if options.transport == 'shm':
+            shm_root = '/dev/shm' if os.path.isdir('/dev/shm') else None
+            self.shared_dir = tempfile.mkdtemp(prefix='dropboxfuse-bench-', dir=shm_root)
+        CacheManager.set_cache('MetadataCache', MetadataCache(client))
+        servers = options.download_servers
+        CacheManager.set_cache('DataCache', DataCache(client,
+                                                      max_bytes=options.memory_cache_size * MB // servers,
+                                                      shared_dir=self.shared_dir))
+        download_manager = DropboxDownloadManager(client,
+                                                  servers=servers,
+                                                  readahead=options.readahead * MB,
+                                                  readahead_total=options.readahead_total * MB // servers,
+                                                  fetch_workers=options.fetch_workers)
+        if options.write_back > 0:
+            self.writeback = DropboxWriteBack(workers=options.write_back)
+        self.fs = DropboxFuse(client, download_manager,
+                              upload_chunk_size=options.upload_chunk_size * MB,
+                              writeback=self.writeback)
+        return dict(seconds=time.time() - started)
+
+    def unmount(self):
+        if self.writeback is not None:
+            self.writeback.shutdown()
+        if self.fs is not None:
+            self.fs.download_manager.shutdown_server()
+        self.server.stop()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+        if self.shared_dir is not None:
+            shutil.rmtree(self.shared_dir, ignore_errors=True)
+
+    def _read(self, path, offsets, data=None):
+        size = self.options.block_size
+        data = self.data if data is None else data
+        samples = list()
+        started = time.time()
+        fh = self.fs('open', path, os.O_RDONLY)
+        for offset in offsets:
+            t = time.time()
+            buf = self.fs('read', path, size, offset, fh)
+            samples.append(time.time() - t)
+            assert buf == data[offset:offset + size], 'bad data at %d' % offset
+        self.fs('release', path, fh)
+        return throughput(len(offsets) * size, time.time() - started, samples)
+
+    def sequential_read(self):
+        offsets = range(0, len(self.data), self.options.block_size)
+        return dict(cold=self._read('/bench/sequential.bin', offsets),
+                    warm=self._read('/bench/sequential.bin', offsets))
+
+    def large_read(self):
+        # the large file read through once, downloading every block,
+        # then the part of it the memory cache holds is read twice,
+        # the second time it is only served from the cache
+        options = self.options
+        size = options.block_size
+        path = '/bench/large.bin'
+        cached = min(options.large_file_size, options.memory_cache_size // 2) * MB
+        download = self._read(path, range(0, len(self.large), size), self.large)
+        self._read(path, range(0, cached, size), self.large)
+        serve = self._read(path, range(0, cached, size), self.large)
+        return dict(download=download, serve=serve)
+
+    def random_read(self):
+        rand = random.Random(self.options.seed)
+        offsets = [rand.randrange(0, len(self.data) - self.options.block_size)
+                   for i in xrange(self.options.random_reads)]
+        return self._read('/bench/random.bin', offsets)
+
+    def concurrent_read(self):
+        # every stream file open at once and read block by block, each
+        # reader thread going round its share of the streams
+        options = self.options
+        size = options.block_size
+        data = self.data[:options.stream_file_size * 1024]
+        paths = ['/streams/f%05d' % s for s in xrange(options.streams)]
+        started = time.time()
+        fhs = [self.fs('open', path, os.O_RDONLY) for path in paths]
+        opened = time.time() - started
+        samples = list()
+
+        def reader(first):
+            mine = range(first, len(paths), options.stream_threads)
+            for offset in xrange(0, len(data), size):
+                for s in mine:
+                    t = time.time()
+                    buf = self.fs('read', paths[s], size, offset, fhs[s])
+                    samples.append(time.time() - t)
+                    assert buf == data[offset:offset + size], 'bad data at %d of %s' % (offset, paths[s])
+
+        started = time.time()
+        readers = [threading.Thread(target=reader, args=(i, )) for i in xrange(options.stream_threads)]
+        for t in readers:
+            t.start()
+        for t in readers:
+            t.join()
+        result = throughput(len(paths) * len(data), time.time() - started, samples)
+        # open files per download server
+        result.update(streams=len(paths), open_seconds=opened, load=self.fs.download_manager.load())
+        for path, fh in zip(paths, fhs):
+            self.fs('release', path, fh)
+        return result
+
+    def open_close(self):
+        # the stream files opened, read from and closed again from
+        # several threads, each open and close is a control request
+        options = self.options
+        paths = ['/streams/f%05d' % (s % options.streams) for s in xrange(options.opens)]
+        size = options.block_size
+        samples = list()
+
+        def opener(first):
+            for path in paths[first::options.stream_threads]:
+                t = time.time()
+                fh = self.fs('open', path, os.O_RDONLY)
+                self.fs('read', path, size, 0, fh)
+                self.fs('release', path, fh)
+                samples.append(time.time() - t)
+
+        started = time.time()
+        openers = [threading.Thread(target=opener, args=(i, )) for i in xrange(options.stream_threads)]
+        for t in openers:
+            t.start()
+        for t in openers:
+            t.join()
+        seconds = time.time() - started
+        result = summary(samples)
+        result.update(seconds=seconds, opens_per_second=len(paths) / seconds)
+        return result
+
+    def _timed(self, op, paths):
+        samples = list()
+        for path in paths:
+            t = time.time()
+            op(path)
+            samples.append(time.time() - t)
+        return summary(samples)
+
+    def metadata(self):
+        # the first half of the directories is listed, the other half
+        # is only looked up file by file
+        options = self.options
+        listed = ['/tree/d%04d' % d for d in xrange(options.dirs // 2)]
+        unlisted = ['/tree/d%04d' % d for d in xrange(options.dirs // 2, options.dirs)]
+        files = lambda dirs: ['%s/f%05d' % (d, f) for d in dirs for f in xrange(options.files)]
+        readdir = lambda path: self.fs('readdir', path, 0)
+        stat = lambda path: self.fs('getattr', path)
+        return dict(readdir_cold=self._timed(readdir, listed),
+                    readdir_warm=self._timed(readdir, listed),
+                    getattr_listed=self._timed(stat, files(listed)),
+                    getattr_cold=self._timed(stat, files(unlisted)),
+                    getattr_warm=self._timed(stat, files(unlisted)))
+
+    def memory(self):
+        # every directory of the tree listed
+        for d in xrange(self.options.dirs):
+            self.fs('readdir', '/tree/d%04d' % d, 0)
+        mcache = CacheManager.get_cache('MetadataCache')
+        with mcache.lock:
+            entries = mcache.count()
+            size = deep_size([mcache.root])
+        return dict(entries=entries, bytes=size, bytes_per_entry=size / entries)
+
+    def upload(self):
+        size = self.options.block_size
+        samples = list()
+        started = time.time()
+        for i in xrange(self.options.uploads):
+            path = '/bench/upload-%d.bin' % i
+            fh = self.fs('create', path, 0644)
+            for offset in xrange(0, len(self.data), size):
+                t = time.time()
+                self.fs('write', path, self.data[offset:offset + size], offset, fh)
+                samples.append(time.time() - t)
+            self.fs('release', path, fh)
+        if self.writeback is not None:
+            self.writeback.shutdown()
+            self.writeback = None
+        return throughput(self.options.uploads * len(self.data), time.time() - started, samples)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--output', type=str, default=None, required=False,
+                        help='json file for the results, stdout by default')
+    parser.add_argument('--latency', type=float, default=0, required=False,
+                        help='delay of every request to the fake server in ms')
+    parser.add_argument('--bandwidth', type=float, default=0, required=False,
+                        help='bandwidth of each connection to the fake server in MB/s, 0 for no limit')
+    parser.add_argument('--file-size', type=int, default=64, required=False,
+                        help='size of the read and uploaded files in MB')
+    parser.add_argument('--large-file-size', type=int, default=0, required=False,
+                        help='size of the file read by the large file benchmark in MB, 0 to skip it')
+    parser.add_argument('--block-size', type=int, default=128 * 1024, required=False,
+                        help='bytes read or written by each fuse request')
+    parser.add_argument('--random-reads', type=int, default=500, required=False)
+    parser.add_argument('--uploads', type=int, default=2, required=False)
+    parser.add_argument('--dirs', type=int, default=20, required=False,
+                        help='directories of the metadata tree')
+    parser.add_argument('--files', type=int, default=500, required=False,
+                        help='files in each directory of the metadata tree')
+    parser.add_argument('--streams', type=int, default=1000, required=False,
+                        help='files open at once for the concurrent read benchmark, 0 to skip it')
+    parser.add_argument('--stream-file-size', type=int, default=512, required=False,
+                        help='size of each concurrently read file in KB')
+    parser.add_argument('--opens', type=int, default=4000, required=False,
+                        help='files opened and closed again after the concurrent reads')
+    parser.add_argument('--stream-threads', type=int, default=16, required=False,
+                        help='threads reading the concurrently open files')
+    parser.add_argument('--seed', type=int, default=0, required=False)
+    parser.add_argument('--log-level', type=str, choices=('debug', 'info', 'warning', 'error'), default='warning',
+                        required=False)
+    # tuning knobs, as in dropbox_fuse.py
+    parser.add_argument('--transport', type=str, choices=('socket', 'shm'), default='socket', required=False)
+    parser.add_argument('--memory-cache-size', type=int, default=256, required=False)
+    parser.add_argument('--readahead', type=int, default=32, required=False)
+    parser.add_argument('--readahead-total', type=int, default=256, required=False)
+    parser.add_argument('--fetch-workers', type=int, default=8, required=False)
+    parser.add_argument('--download-servers', type=int, default=1, required=False)
+    parser.add_argument('--upload-chunk-size', type=int, default=8, required=False)
+    parser.add_argument('--write-back', type=int, default=0, required=False)
+    options = parser.parse_args()
+
+    log_manager = DropboxLogManager(level=getattr(logging, options.log_level.upper()))
+    # there is no fuse request to take the caller from outside a mount
+    fuse.fuse_get_context = lambda: (os.getuid(), os.getgid(), os.getpid())
+
+    benchmark = Benchmark(options)
+    results = dict()
+    try:
+        results['startup'] = benchmark.mount()
+        results['sequential_read'] = benchmark.sequential_read()
+        results['random_read'] = benchmark.random_read()
+        if options.large_file_size > 0:
+            results['large_read'] = benchmark.large_read()
+        if options.streams > 0:
+            results['concurrent_read'] = benchmark.concurrent_read()
+            results['open_close'] = benchmark.open_close()
+        results['metadata'] = benchmark.metadata()
+        results['memory'] = benchmark.memory()
+        results['upload'] = benchmark.upload()
+        results['requests'] = benchmark.server.stats()
+    finally:
+        benchmark.unmount()
+        log_manager.stop()
+
+    report = dict(options=vars(options), results=results, time=time.time())
+    if options.output is None:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print
+    else:
+        with open(options.output, 'wb') as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,229 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+
+import os
+import errno
+import hashlib
+import zlib
+from collections import OrderedDict
+
+from dropbox_logger import DropboxLogManager
+
+
+class DropboxBlockStore(object):
+    """
+    Disk backed store of fixed-size file blocks.
+
+    Blocks are kept as one file per block under `path`/blocks, keyed by
+    the dropbox path and rev of the file they belong to.
+    The index is an append-only journal, so a restart only replays the
+    journal instead of scanning the block files. Every journal record
+    carries the block crc, a block that was not fully written before a
+    crash fails the check and is treated as a miss.
+    """
+    VERSION = 1
+    JOURNAL = 'journal'
+    BLOCKS = 'blocks'
+
+    def __init__(self, path, max_bytes, block_size):
+        self.logger = DropboxLogManager.get_logger(self)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        # (key, index) --> (size, crc), in LRU order
+        self.blocks = OrderedDict()
+        self.bytes_held = 0
+        self.bytes_evicted = 0
+        self._journal = None
+        self._journal_records = 0
+
+        self._makedirs(os.path.join(self.path, DropboxBlockStore.BLOCKS))
+        self._load_journal()
+
+    def _makedirs(self, path):
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    @property
+    def header(self):
+        return '# dropboxfuse blocks %d %d\n' % (DropboxBlockStore.VERSION, self.block_size)
+
+    @staticmethod
+    def key(path, rev):
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        return hashlib.sha1('%s\0%s' % (path.lower(), rev)).hexdigest()
+
+    def _block_path(self, key, index):
+        return os.path.join(self.path, DropboxBlockStore.BLOCKS, '%s.%d' % (key, index))
+
+    def _journal_path(self):
+        return os.path.join(self.path, DropboxBlockStore.JOURNAL)
+
+    def _load_journal(self):
+        path = self._journal_path()
+        if not os.path.isfile(path):
+            return
+
+        with open(path, 'rb') as fp:
+            if fp.readline() != self.header:
+                self.logger.warn('%s: unknown journal format, dropping block store', self.path)
+                self._reset()
+                return
+
+            for line in fp:
+                self._journal_records += 1
+                fields = line.split()
+                try:
+                    if fields[0] == '+' and len(fields) == 5:
+                        key, index, size, crc = fields[1], int(fields[2]), int(fields[3]), int(fields[4])
+                        self._add(key, index, size, crc)
+                    elif fields[0] == '-' and len(fields) == 3:
+                        self._remove(fields[1], int(fields[2]))
+                    else:
+                        raise ValueError(line)
+                except (IndexError, ValueError):
+                    # a torn record at the end of the journal
+                    self.logger.warn('%s: skipping bad journal record %r', self.path, line)
+
+        self.logger.info('%s: loaded %d blocks (%d bytes)', self.path, len(self.blocks), self.bytes_held)
+        self._compact()
+        # the budget might have shrunk since the last run
+        self._evict()
+
+    def _reset(self):
+        for name in os.listdir(os.path.join(self.path, DropboxBlockStore.BLOCKS)):
+            os.unlink(os.path.join(self.path, DropboxBlockStore.BLOCKS, name))
+        if os.path.isfile(self._journal_path()):
+            os.unlink(self._journal_path())
+        self.blocks = OrderedDict()
+        self.bytes_held = 0
+        self._journal_records = 0
+
+    def _close_journal(self):
+        if self._journal is None:
+            return
+        try:
+            self._journal.close()
+        except (IOError, OSError) as e:
+            self.logger.error('%s: failed to close the journal: %s', self.path, str(e))
+        self._journal = None
+
+    def _compact(self):
+        # rewrite the journal with the live records only
+        self._close_journal()
+
+        tmp_path = self._journal_path() + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as fp:
+                fp.write(self.header)
+                for (key, index), (size, crc) in self.blocks.iteritems():
+                    fp.write('+ %s %d %d %d\n' % (key, index, size, crc))
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.rename(tmp_path, self._journal_path())
+        except (IOError, OSError) as e:
+            # the old journal stays, it is compacted again later
+            self.logger.error('%s: failed to compact the journal: %s', self.path, str(e))
+            self._unlink_path(tmp_path)
+            return
+        self._journal_records = len(self.blocks)
+
+    def _append(self, record):
+        # like the blocks, the journal is best-effort, the records
+        # that did not make it only cost misses after a restart
+        try:
+            if self._journal is None:
+                if not os.path.isfile(self._journal_path()):
+                    self._compact()
+                self._journal = open(self._journal_path(), 'ab')
+            self._journal.write(record)
+            self._journal.flush()
+        except (IOError, OSError) as e:
+            self.logger.error('%s: failed to write the journal: %s', self.path, str(e))
+            self._close_journal()
+            return
+        self._journal_records += 1
+
+        if self._journal_records > 2 * len(self.blocks) + 1024:
+            self._compact()
+
+    def _add(self, key, index, size, crc):
+        self._remove(key, index)
+        self.blocks[(key, index)] = (size, crc)
+        self.bytes_held += size
+
+    def _remove(self, key, index):
+        entry = self.blocks.pop((key, index), None)
+        if entry is not None:
+            self.bytes_held -= entry[0]
+        return entry
+
+    def _unlink(self, key, index):
+        self._unlink_path(self._block_path(key, index))
+
+    def _unlink_path(self, path):
+        try:
+            os.unlink(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                self.logger.error('failed to remove %s: %s', path, str(e))
+
+    def _drop(self, key, index):
+        if self._remove(key, index) is None:
+            return
+        self._append('- %s %d\n' % (key, index))
+        self._unlink(key, index)
+
+    def _evict(self):
+        while self.bytes_held > self.max_bytes and len(self.blocks) > 0:
+            (key, index), (size, crc) = next(self.blocks.iteritems())
+            self.logger.debug('evicting block %s.%d (%d bytes)', key, index, size)
+            self._drop(key, index)
+            self.bytes_evicted += size
+
+    def get(self, path, rev, index):
+        key = DropboxBlockStore.key(path, rev)
+        entry = self.blocks.get((key, index))
+        if entry is None:
+            return None
+
+        size, crc = entry
+        try:
+            with open(self._block_path(key, index), 'rb') as fp:
+                data = fp.read()
+        except IOError as e:
+            self.logger.error('%s: failed to read block %d: %s', path, index, str(e))
+            data = None
+
+        if data is None or len(data) != size or zlib.crc32(data) != crc:
+            self.logger.warn('%s: block %d is corrupted, dropping it', path, index)
+            self._drop(key, index)
+            return None
+
+        # move to the most recently used end
+        self.blocks[(key, index)] = self.blocks.pop((key, index))
+        return data
+
+    def put(self, path, rev, index, data):
+        if len(data) > self.max_bytes:
+            return
+
+        key = DropboxBlockStore.key(path, rev)
+        block_path = self._block_path(key, index)
+        tmp_path = block_path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as fp:
+                fp.write(data)
+            os.rename(tmp_path, block_path)
+        except (IOError, OSError) as e:
+            self.logger.error('%s: failed to store block %d: %s', path, index, str(e))
+            return
+
+        crc = zlib.crc32(data)
+        self._add(key, index, len(data), crc)
+        self._append('+ %s %d %d %d\n' % (key, index, len(data), crc))
+        self._evict()
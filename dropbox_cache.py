@@ -2,10 +2,20 @@
 # -*- coding: utf-8 -*-
 
 import os
-import random
+import mmap
+import socket
+import stat
+import tempfile
+import threading
+import time
 import dropbox
-from dropbox_exceptions import FileNotFoundError
+from collections import OrderedDict
+from urllib3.exceptions import HTTPError
+from dropbox_exceptions import FileNotFoundError, DownloadError
 from dropbox_logger import DropboxLogManager
+from dropbox_metrics import DropboxMetrics
+from dropbox_download_ipc import StreamProtocol
+from dropbox_utils import compact_string
 
 
 class CacheManager(object):
@@ -25,6 +35,8 @@ class CacheBase(object):
         self.logger = DropboxLogManager.get_logger(self)
         self.cache = dict()
         self.client = client
+        # guards self.cache when fuse runs multi-threaded
+        self.lock = threading.RLock()
 
     def get_cache(self):
         return self.cache
@@ -35,60 +47,403 @@ class CacheBase(object):
     def set_entry(self, path, entry):
         self.logger.debug('setting entry for %s', path)
         assert isinstance(path, (str, unicode))
-        self.cache[path] = entry
+        with self.lock:
+            self.cache[path] = entry
 
     def remove_entry(self, path):
         self.logger.info('removing entry for %s', path)
-        assert path in self.cache, 'path is not in cache'
-        del self.cache[path]
+        with self.lock:
+            assert path in self.cache, 'path is not in cache'
+            del self.cache[path]
 
 
 class MetadataCache(CacheBase):
+    # most paths known not to exist that are remembered
+    NEGATIVE_MAX = 100000
+
+    def __init__(self, client, negative_ttl=30):
+        super(MetadataCache, self).__init__(client)
+        self.op_logger = DropboxLogManager.get_op_logger(self)
+        # the entries form a tree, every directory maps the lower-cased
+        # names of its children to their entries since dropbox paths are
+        # case-insensitive. Entries without metadata only hold the path
+        # to entries below them
+        self.root = MetadataCacheEntry('/', client)
+        # lower-cased path --> expiry time of a path known not to exist
+        # in the order they expire, the ttl is the same for all
+        self.negative = OrderedDict()
+        self.negative_ttl = negative_ttl
+        # lower-cased path --> snapshot record of an entry saved by a
+        # previous mount, turned into a cache entry on first lookup
+        self.snapshot = dict()
+        # lower-cased paths of cache entries taken from the snapshot
+        # that were not revalidated yet
+        self.unvalidated = set()
+        DropboxMetrics.gauge('dropbox_metadata_cache_entries', self.count)
+
+    def get_cache(self):
+        return self.root
+
+    def _node(self, path, create=False):
+        # the entry at path, entries without metadata are created
+        # along the way when create is True
+        node = self.root
+        for name in path.split('/'):
+            if not name:
+                continue
+            children = node.children
+            child = children.get(name.lower()) if children is not None else None
+            if child is None:
+                if create is False:
+                    return None
+                child = MetadataCacheEntry(node.path.rstrip('/') + '/' + name, self.client)
+                node.link(child)
+            node = child
+        return node
+
     def get_entry(self, path, create=True):
         super(MetadataCache, self).get_entry(path)
-        cache_entry = self.cache.get(path)
+        cache_entry = self._node(path)
+        if cache_entry is None or cache_entry.is_dir is None:
+            cache_entry = self._entry_from_snapshot(path)
+
         if cache_entry is None:
             self.logger.info('cache miss %s', path)
             if create is False:
                 return None
 
-            cache_entry = MetadataCacheEntry(path, self.client).fetch()
-            self.set_entry(path, cache_entry)
+            if self._is_negative(path):
+                self.logger.info('negative cache hit %s', path)
+                DropboxMetrics.inc('dropbox_metadata_cache_requests_total', result='negative')
+                raise FileNotFoundError('%s does not exist' % path)
+
+            DropboxMetrics.inc('dropbox_metadata_cache_requests_total', result='miss')
 
-            if cache_entry.metadata['is_dir'] is True:
-                self.logger.info('its a dir --> precaching sub-entries')
-                for content in cache_entry.metadata['contents']:
-                    path = content['path']
-                    self.logger.info('adding %s', path)
-                    self.set_entry(path, MetadataCacheEntry(path, self.client, metadata=content))
+            # fetch without holding the lock, a slow metadata()
+            # call should not block lookups of other paths
+            try:
+                cache_entry = MetadataCacheEntry(path, self.client).fetch()
+            except FileNotFoundError:
+                self._set_negative(path)
+                raise
+            self.set_entry(path, cache_entry)
         else:
-            self.logger.info('cache hit %s', path)
+            self.op_logger.debug('cache hit %s', path)
+            DropboxMetrics.inc('dropbox_metadata_cache_requests_total', result='hit')
+        return cache_entry
+
+    def list_directory(self, path):
+        # returns the entry of a directory with its children listed
+        cache_entry = self.get_entry(path)
+        if cache_entry.dirty is False and cache_entry.is_dir is True and cache_entry.listed is False:
+            self._listing_from_snapshot(cache_entry)
+        if cache_entry.dirty is False and (cache_entry.is_dir is not True or cache_entry.listed is True):
+            return cache_entry
+
+        try:
+            cache_entry.fetch()
+        except FileNotFoundError:
+            with self.lock:
+                if self._node(path) is cache_entry:
+                    self.remove_entry(path)
+            self._set_negative(path)
+            raise
         return cache_entry
 
     def set_entry(self, path, entry):
         assert isinstance(entry, MetadataCacheEntry)
-        super(MetadataCache, self).set_entry(path, entry)
+        with self.lock:
+            current = self._node(path)
+            if current is not entry:
+                self.logger.debug('setting entry for %s', path)
+                if current is not None:
+                    # keep what we know about the entries below it
+                    entry.adopt(current)
+                if current is self.root:
+                    entry.parent = None
+                    self.root = entry
+                else:
+                    self._node(os.path.dirname(path), create=True).link(entry)
+            lower_path = path.lower()
+            self.negative.pop(lower_path, None)
+            self.snapshot.pop(lower_path, None)
+            self.unvalidated.discard(lower_path)
 
-    def set_parent_dirty(self, cache_entry):
-        self.logger.info('%s: setting parent entry as dirty', cache_entry.path)
-        path = cache_entry.path
-        path = os.path.dirname(path)
+    def _set_negative(self, path):
+        now = time.time()
+        with self.lock:
+            lower_path = path.lower()
+            self.negative.pop(lower_path, None)
+            self.negative[lower_path] = now + self.negative_ttl
+            # paths probed only once would pile up otherwise
+            while self.negative:
+                oldest, expires = next(self.negative.iteritems())
+                if expires > now and len(self.negative) <= MetadataCache.NEGATIVE_MAX:
+                    break
+                del self.negative[oldest]
+
+    def _is_negative(self, path):
+        lower_path = path.lower()
+        with self.lock:
+            expires = self.negative.get(lower_path)
+            if expires is not None:
+                if expires > time.time():
+                    return True
+                del self.negative[lower_path]
+
+            # a listed parent tells us about all of its children
+            parent = self._node(os.path.dirname(lower_path))
+            if lower_path == '/' or parent is None or parent.dirty is True or parent.listed is False:
+                return False
+            return os.path.basename(lower_path) not in parent.children
+
+    def remove_entry(self, path):
+        # the entries below it go with it
+        self.logger.info('removing entry for %s', path)
+        DropboxMetrics.inc('dropbox_metadata_cache_removals_total')
+        with self.lock:
+            cache_entry = self._node(path)
+            assert cache_entry is not None, 'path is not in cache'
+            if cache_entry.parent is not None:
+                cache_entry.parent.unlink(cache_entry)
+            self.snapshot.pop(path.lower(), None)
+
+    def walk(self, cache_entry=None):
+        # the entries with metadata, cache_entry and all entries below it
+        stack = [self.root if cache_entry is None else cache_entry]
+        while stack:
+            cache_entry = stack.pop()
+            if cache_entry.children is not None:
+                stack.extend(cache_entry.children.values())
+            if cache_entry.is_dir is not None:
+                yield cache_entry
+
+    def count(self):
+        return self.root.entries
+
+    @staticmethod
+    def _snapshot_record(cache_entry):
+        # (metadata without contents, lower-cased child paths or None)
+        metadata = cache_entry.to_metadata(contents=False)
+        if cache_entry.listed is False:
+            return metadata, None
+        return metadata, [child.path.lower() for child in cache_entry.children.values()]
+
+    def _metadata_from_snapshot(self, lower_path):
+        record = self.snapshot.get(lower_path)
+        if record is None:
+            return None
+
+        metadata, children = record
+        metadata = dict(metadata)
+        if children is not None:
+            contents = list()
+            for child in children:
+                if child in self.snapshot:
+                    contents.append(self.snapshot[child][0])
+                    continue
+                # the child might have been taken from the snapshot already
+                cache_entry = self._node(child)
+                if cache_entry is not None and cache_entry.is_dir is not None:
+                    contents.append(cache_entry.to_metadata(contents=False))
+            if len(contents) == len(children):
+                metadata['contents'] = contents
+            else:
+                # the listing is incomplete, have it fetched again
+                metadata.pop('hash', None)
+        return metadata
+
+    def _drop_snapshot_children(self, cache_entry):
+        # the children of a snapshot listing are cached along with it,
+        # their own listings stay in the snapshot until they are listed
+        if cache_entry.listed is False:
+            return
+        for child in cache_entry.children.values():
+            lower_path = child.path.lower()
+            record = self.snapshot.get(lower_path)
+            if record is not None and record[1] is None:
+                del self.snapshot[lower_path]
+
+    def _entry_from_snapshot(self, path):
+        with self.lock:
+            if len(self.snapshot) == 0 or path.lower() not in self.snapshot:
+                return None
+            metadata = self._metadata_from_snapshot(path.lower())
+            self.logger.info('snapshot hit %s', path)
+            cache_entry = MetadataCacheEntry(path, self.client, metadata=metadata)
+            self.set_entry(path, cache_entry)
+            self._drop_snapshot_children(cache_entry)
+            self.unvalidated.add(path.lower())
+            return cache_entry
+
+    def _listing_from_snapshot(self, cache_entry):
+        # a directory cached from its parent's snapshot listing
+        with self.lock:
+            lower_path = cache_entry.path.lower()
+            metadata = self._metadata_from_snapshot(lower_path)
+            if metadata is None or 'contents' not in metadata:
+                return
+            self.logger.info('snapshot listing hit %s', cache_entry.path)
+            del self.snapshot[lower_path]
+            cache_entry.set_metadata(metadata)
+            self._drop_snapshot_children(cache_entry)
+            self.unvalidated.add(lower_path)
+
+    def load_snapshot(self, records):
+        with self.lock:
+            for lower_path, record in records.iteritems():
+                cache_entry = self._node(lower_path)
+                if cache_entry is None or cache_entry.is_dir is None:
+                    self.snapshot[lower_path] = record
 
+    def dump_snapshot(self):
+        with self.lock:
+            records = dict(self.snapshot)
+            for cache_entry in self.walk():
+                if cache_entry.uploader is not None:
+                    continue
+                lower_path = cache_entry.path.lower()
+                if cache_entry.listed is False and lower_path in records:
+                    # keep the listing the snapshot still has
+                    continue
+                records[lower_path] = MetadataCache._snapshot_record(cache_entry)
+        return records
+
+    def snapshot_directories(self):
+        # listed directories of the snapshot, parents first
+        with self.lock:
+            paths = [p for p, (metadata, children) in self.snapshot.iteritems() if children is not None]
+            paths += list(self.unvalidated)
+        return sorted(set(paths), key=lambda p: (p.count('/'), p))
+
+    def revalidate(self, lower_path):
+        with self.lock:
+            self.unvalidated.discard(lower_path)
+            cache_entry = self._node(lower_path)
+            if cache_entry is not None and cache_entry.listed is True:
+                metadata = cache_entry.to_metadata()
+            else:
+                metadata = self._metadata_from_snapshot(lower_path)
+        if metadata is None or 'hash' not in metadata or 'contents' not in metadata:
+            return
+
+        # fetch() keeps the listing as is when the hash did not change
+        entry = MetadataCacheEntry(metadata['path'], self.client, metadata=metadata)
         try:
-            cache_entry = self.get_entry(path)
-            cache_entry.dirty = True
-        except FileNotFoundError as e:
-            self.logger.error('parent not found, not setting dirty flag %s', e)
+            entry.fetch()
+        except FileNotFoundError:
+            self.apply_delta([[lower_path, None]])
+            return
+        if entry.hash == metadata['hash']:
+            return
+
+        self.logger.info('revalidate: %s changed', metadata['path'])
+        contents = [child.to_metadata() for child in entry.children.values()]
+        previous = dict((content['path'].lower(), content) for content in metadata['contents'])
+        fresh = set(content['path'].lower() for content in contents)
+        # only the children that were removed or changed
+        entries = [[child, None] for child in previous if child not in fresh]
+        entries += [[content['path'].lower(), content] for content in contents
+                    if previous.get(content['path'].lower()) != content]
+        with self.lock:
+            self.apply_delta(entries)
+            cache_entry = self._node(lower_path)
+            if cache_entry is not None and cache_entry.is_dir is not None:
+                self.snapshot.pop(lower_path, None)
+                cache_entry.update(hash=entry.hash)
+                cache_entry.set_listing(entry.children.values())
+            else:
+                self.snapshot[lower_path] = MetadataCache._snapshot_record(entry)
+                for child in entry.children.values():
+                    child_path = child.path.lower()
+                    if self._node(child_path) is None and child_path not in self.snapshot:
+                        self.snapshot[child_path] = MetadataCache._snapshot_record(child)
+
+    def apply_delta(self, entries, reset=False):
+        # entries are [lower-cased path, metadata or None] as returned by delta()
+        with self.lock:
+            if reset is True:
+                self.logger.info('delta reset, dropping all cached entries')
+                uploading = [e for e in self.walk() if e.uploader is not None]
+                self.root = MetadataCacheEntry('/', self.client)
+                self.negative.clear()
+                self.snapshot.clear()
+                self.unvalidated.clear()
+                # files being uploaded stay until they are committed
+                for entry in uploading:
+                    self.set_entry(entry.path, entry)
+
+            for lower_path, metadata in entries:
+                if metadata is None:
+                    self._delta_remove(lower_path)
+                else:
+                    self._delta_update(lower_path, metadata)
+
+    def _delta_update(self, lower_path, metadata):
+        # the snapshot no longer describes this path or its parent listing
+        self.snapshot.pop(lower_path, None)
+        self.snapshot.pop(os.path.dirname(lower_path), None)
+
+        cache_entry = self._node(lower_path)
+        if cache_entry is not None and cache_entry.uploader is not None:
+            # the local upload wins until it is committed
+            return
+
+        parent = self._node(os.path.dirname(lower_path))
+        listed = parent is not None and parent.listed is True
+        if (cache_entry is None or cache_entry.is_dir is None) and not listed:
+            # nothing we know about, it will be fetched when needed
+            return
+
+        self.logger.info('delta: updating %s', metadata['path'])
+        entry = MetadataCacheEntry(metadata['path'], self.client, metadata=metadata)
+        if cache_entry is not None and cache_entry.is_dir is entry.is_dir:
+            # a folder keeps its listing, only its own metadata changed
+            cache_entry.assign(entry)
+        else:
+            self.set_entry(metadata['path'], entry)
+
+    def _delta_remove(self, lower_path):
+        if len(self.snapshot) > 0:
+            prefix = lower_path.rstrip('/') + '/'
+            for snapshot_path in self.snapshot.keys():
+                if snapshot_path == lower_path or snapshot_path.startswith(prefix):
+                    del self.snapshot[snapshot_path]
+            self.snapshot.pop(os.path.dirname(lower_path), None)
+
+        cache_entry = self._node(lower_path)
+        if cache_entry is None or cache_entry.uploader is not None:
+            return
+
+        self.logger.info('delta: removing %s', cache_entry.path)
+        uploading = [e for e in self.walk(cache_entry) if e.uploader is not None]
+        self.remove_entry(lower_path)
+        # files being uploaded below it stay until they are committed
+        for entry in uploading:
+            self.set_entry(entry.path, entry)
+
+    def set_parent_dirty(self, cache_entry):
+        self.logger.info('%s: setting parent entry as dirty', cache_entry.path)
+        parent = cache_entry.parent
+        if parent is None or parent.is_dir is None:
+            self.logger.error('parent of %s is not cached, not setting dirty flag', cache_entry.path)
+            return
+        parent.dirty = True
 
 
 class CacheEntryBase(object):
+    __slots__ = ('path', 'client', '_dirty', '_is_cached')
+
     def __init__(self, path, client):
-        self.logger = DropboxLogManager.get_logger(self)
         self.path = path
         self.client = client
         self._dirty = False
         self._is_cached = False
 
+    @property
+    def logger(self):
+        return DropboxLogManager.get_logger(self)
+
     def fetch(self):
         self._dirty = False
         return self
@@ -118,16 +473,162 @@ class CacheEntryBase(object):
 
 
 class MetadataCacheEntry(CacheEntryBase):
+    """
+    The fields of the Dropbox metadata fuse needs, is_dir is None until
+    the metadata is known. An entry is a node of the MetadataCache tree,
+    children maps the lower-cased names of the entries below it to them
+    and is the whole folder listing once listed is True.
+    """
+    __slots__ = ('is_dir', 'size', 'rev', 'modified', 'hash', 'parent', 'children', 'listed',
+                 'entries', '_uploader', '_stat')
+    # guards the entries counts, entries are also changed outside of
+    # the MetadataCache lock
+    count_lock = threading.RLock()
+
     def __init__(self, path, client, metadata=None, uploader=None):
-        self._metadata = dict() if metadata is None else metadata
+        super(MetadataCacheEntry, self).__init__(compact_string(path), client)
         self._uploader = uploader
-        super(MetadataCacheEntry, self).__init__(path, client)
+        self.is_dir = None
+        self.size = 0
+        self.rev = None
+        self.modified = None
+        self.hash = None
+        self.parent = None
+        self.children = None
+        self.listed = False
+        # entries with metadata at and below us, the cache size is
+        # the count of the root
+        self.entries = 0
+        # getattr() attributes, built on first use
+        self._stat = None
+        if metadata is not None:
+            self.set_metadata(metadata)
+
+    @property
+    def name(self):
+        # the key of the entry in its parent's children
+        return compact_string(self.path.rsplit('/', 1)[-1].lower())
+
+    def _add_entries(self, delta):
+        # counted up to the root, as long as we are still linked
+        if delta == 0:
+            return
+        with MetadataCacheEntry.count_lock:
+            node = self
+            while True:
+                node.entries += delta
+                parent = node.parent
+                if parent is None or parent.children is None or parent.children.get(node.name) is not node:
+                    return
+                node = parent
+
+    def _recount(self):
+        with MetadataCacheEntry.count_lock:
+            entries = int(self.is_dir is not None)
+            if self.children is not None:
+                entries += sum(child.entries for child in self.children.itervalues())
+            self._add_entries(entries - self.entries)
+
+    def set_metadata(self, metadata):
+        known = self.is_dir is not None
+        self.path = compact_string(metadata.get('path', self.path))
+        self.is_dir = metadata.get('is_dir')
+        self._add_entries((self.is_dir is not None) - known)
+        self.size = int(metadata.get('bytes', 0))
+        self.rev = compact_string(metadata.get('rev'))
+        self.modified = compact_string(metadata.get('modified'))
+        contents = metadata.get('contents')
+        if contents is not None:
+            self.hash = compact_string(metadata.get('hash'))
+            self.set_listing([MetadataCacheEntry(content['path'], self.client, metadata=content)
+                              for content in contents])
+        self._stat = None
+
+    def assign(self, entry):
+        # takes the metadata of entry, keeping the entries below us
+        known = self.is_dir is not None
+        self.path = entry.path
+        self.is_dir = entry.is_dir
+        self._add_entries((self.is_dir is not None) - known)
+        self.size = entry.size
+        self.rev = entry.rev
+        self.modified = entry.modified
+        self._stat = None
+
+    def link(self, entry):
+        if self.children is None:
+            self.children = dict()
+        name = entry.name
+        current = self.children.get(name)
+        entry.parent = self
+        self.children[name] = entry
+        self._add_entries(entry.entries - (current.entries if current is not None else 0))
+
+    def unlink(self, entry):
+        name = entry.name
+        if self.children is not None and self.children.get(name) is entry:
+            del self.children[name]
+            self._add_entries(-entry.entries)
+
+    def set_listing(self, entries):
+        # the entries we already have are updated in place so the
+        # entries below them stay, files being uploaded are kept
+        current = self.children or dict()
+        children = dict()
+        for entry in entries:
+            name = entry.name
+            child = current.get(name)
+            if child is None or (child.uploader is None and child.is_dir not in (None, entry.is_dir)):
+                child = entry
+            elif child.uploader is None:
+                child.assign(entry)
+            child.parent = self
+            children[name] = child
+        for name, child in current.iteritems():
+            if name not in children and child.uploader is not None:
+                children[name] = child
+        self.children = children
+        self.listed = True
+        self._recount()
+
+    def adopt(self, entry):
+        # takes the place of entry in the tree
+        if entry.children is None or self.is_dir is False:
+            return
+        if self.listed is True:
+            listing = self.children.values()
+            self.children = entry.children
+            self.set_listing(listing)
+            return
+        self.children = entry.children
+        self.listed = entry.listed
+        self.hash = entry.hash
+        for child in self.children.itervalues():
+            child.parent = self
+        self._recount()
+
+    def to_metadata(self, contents=True):
+        metadata = dict(path=self.path, is_dir=self.is_dir, bytes=self.size)
+        for key in ('rev', 'modified', 'hash'):
+            value = getattr(self, key)
+            if value is not None:
+                metadata[key] = value
+        if contents and self.listed is True:
+            metadata['contents'] = [child.to_metadata(contents=False) for child in self.children.values()]
+        return metadata
+
+    def update(self, **fields):
+        # changes some of the fields in place
+        known = self.is_dir is not None
+        for name, value in fields.iteritems():
+            setattr(self, name, value)
+        self._add_entries((self.is_dir is not None) - known)
+        self._stat = None
 
     def fetch(self):
         # will work only if is_dir is True, else None
-        prev_hash = self._metadata.get('hash')
         try:
-            metadata = self.client.metadata(self.path, hash=prev_hash)
+            metadata = self.client.metadata(self.path, hash=self.hash)
             if 'is_deleted' in metadata and metadata['is_deleted'] is True:
                 self.logger.error('404: %s already marked as deleted', self.path)
                 raise FileNotFoundError('%s is deleted' % self.path)
@@ -144,9 +645,15 @@ class MetadataCacheEntry(CacheEntryBase):
             else:
                 raise
 
-        self._metadata = metadata
+        self.set_metadata(metadata)
         return super(MetadataCacheEntry, self).fetch()
 
+    def refresh(self):
+        if self.dirty is True:
+            self.logger.info('%s found as dirty, re-fetching', self.path)
+            self.fetch()
+        return self
+
     @property
     def uploader(self):
         return self._uploader
@@ -156,107 +663,502 @@ class MetadataCacheEntry(CacheEntryBase):
         self._uploader = value
 
     @property
-    def metadata(self):
-        if self.dirty is True:
-            self.logger.info('%s found as dirty, re-fetching', self.path)
-            self.fetch()
-        return self._metadata
+    def stat(self):
+        # the attributes getattr() returns, except for the owner
+        self.refresh()
+        if self._stat is None:
+            self._stat = self.make_stat()
+        return self._stat
+
+    def make_stat(self):
+        if self.modified is not None:
+            modified = self.modified.replace('+0000', '').strip()
+            modified = time.mktime(time.strptime(modified, '%a, %d %b %Y %H:%M:%S'))
+        else:
+            modified = time.time()
 
-    @metadata.setter
-    def metadata(self, value):
-        assert isinstance(value, dict)
-        self._metadata = value
+        ret = dict(
+            st_size=self.size,
+            st_ctime=modified,
+            st_mtime=modified,
+            st_atime=modified
+        )
+        if self.is_dir is True:
+            ret['st_mode'] = stat.S_IFDIR | 0755
+            ret['st_nlink'] = 3
+        else:
+            ret['st_mode'] = stat.S_IFREG | 0644
+            ret['st_nlink'] = 1
+        return ret
 
 
 class DataCache(CacheBase):
-    def get_entry(self, path, size, create=True):
+    def __init__(self, client, store=None, max_bytes=None, shared_dir=None):
+        super(DataCache, self).__init__(client)
+        # when set, blocks are kept in memory-mapped files under
+        # this directory and read by the fuse process directly
+        self.shared_dir = shared_dir
+        # entries in LRU order, the least recently used first
+        self.cache = OrderedDict()
+        # optional DropboxBlockStore backing the in-memory blocks
+        self.store = store
+        # memory budget for cached blocks, None for unlimited
+        self.max_bytes = max_bytes
+        self.bytes_held = 0
+        self.bytes_evicted = 0
+
+    def get_entry(self, path, size, rev=None, create=True, acquire=False):
+        # with acquire the entry is returned acquired, a new entry
+        # can not be evicted by the trim() that adds it then
         super(DataCache, self).get_entry(path)
         cache_entry = self.cache.get(path)
-        if cache_entry is not None:
-            if cache_entry.size != size:
-                self.logger.info('%s: inconsistent size, setting as dirty', path)
-                cache_entry.dirty = True
-            else:
-                # just print, returns cache_entry later
-                self.logger.info('data cache: hit %s', path)
-        else:
+        result = 'miss'
+        if cache_entry is not None and not cache_entry.matches(size, rev):
+            # streams that are still open keep reading the old entry,
+            # new streams get a fresh one
+            self.logger.info('%s: rev %s is stale, dropping cache entry', path, cache_entry.rev)
+            result = 'stale'
+            cache_entry = None
+        elif cache_entry is not None:
+            # just print, returns cache_entry later
+            self.logger.debug('data cache: hit %s', path)
+            DropboxMetrics.inc('dropbox_data_cache_requests_total', result='hit')
+            self._touch(path)
+            if acquire:
+                self.acquire(cache_entry)
+
+        if cache_entry is None:
             self.logger.info('data cache miss %s', path)
             if create is False:
                 return None
 
-            cache_entry = DataCacheEntry(path, size, self.client).fetch()
+            DropboxMetrics.inc('dropbox_data_cache_requests_total', result=result)
+
+            if self.shared_dir is not None:
+                cache_entry = SharedDataCacheEntry(path, size, self.client, self.shared_dir,
+                                                   rev=rev, store=self.store)
+            else:
+                cache_entry = DataCacheEntry(path, size, self.client, rev=rev, store=self.store)
+            cache_entry = cache_entry.fetch()
+            if acquire:
+                self.acquire(cache_entry)
             self.set_entry(path, cache_entry)
 
         return cache_entry
 
     def set_entry(self, path, entry):
         assert isinstance(entry, DataCacheEntry), 'expected DataCacheEntry, got %s' % (type(entry), )
+        old_entry = self.cache.get(path)
+        if old_entry is not None and old_entry is not entry:
+            self._detach(old_entry)
+            if old_entry.users == 0:
+                self._discard(old_entry)
         super(DataCache, self).set_entry(path, entry)
+        if entry.owner is not self:
+            entry.owner = self
+            self.bytes_held += entry.bytes_held
+            self.trim()
+
+    def remove_entry(self, path):
+        entry = self.cache.get(path)
+        super(DataCache, self).remove_entry(path)
+        self._detach(entry)
+
+    def _detach(self, entry):
+        # the entry might still be used by an open stream,
+        # it just stops counting against our budget
+        entry.owner = None
+        self.bytes_held -= entry.bytes_held
+
+    def _discard(self, entry):
+        # nobody reads the entry anymore, stop its downloads and free its blocks
+        for fetcher in list(entry.fetchers):
+            entry.remove_fetcher(fetcher)
+        entry.drop_blocks()
+
+    def _touch(self, path):
+        self.cache[path] = self.cache.pop(path)
+
+    def block_added(self, entry, size):
+        self.bytes_held += size
+        self.trim()
+
+    def block_removed(self, entry, size):
+        self.bytes_held -= size
+
+    def acquire(self, entry):
+        entry.users += 1
+
+    def release(self, entry):
+        assert entry.users > 0, 'releasing an unused entry'
+        entry.users -= 1
+        if entry.users == 0 and entry.owner is self:
+            self._touch(entry.path)
+            self.trim()
+        elif entry.users == 0:
+            # the entry was replaced while it was read, nobody needs it anymore
+            self._discard(entry)
+
+    def trim(self):
+        if self.max_bytes is None:
+            return
+
+        for path, entry in self.cache.items():
+            if self.bytes_held <= self.max_bytes:
+                break
+            if entry.users > 0 or len(entry.fetchers) > 0:
+                continue
+
+            size = entry.bytes_held
+            self.logger.info('evicting %s (%d bytes)', os.path.basename(path), size)
+            self.remove_entry(path)
+            entry.drop_blocks()
+            self.bytes_evicted += size
+            DropboxMetrics.inc('dropbox_data_cache_evictions_total')
+            DropboxMetrics.inc('dropbox_data_cache_evicted_bytes_total', size)
 
 
 class DataCacheEntry(CacheEntryBase):
-    def __init__(self, path, size, client):
-        self.size = size
-        self._fp = None
-        self._fd = None
-        self._buffer = bytearray()
+    BLOCK_SIZE = 1024 * 1024
+    shared = False
+
+    def __init__(self, path, size, client, rev=None, store=None):
+        self.size = int(size)
+        self.rev = rev
+        self._store = store
+        # block index --> block data, every block is BLOCK_SIZE bytes
+        # except for the last block of the file
+        self._blocks = dict()
+        self._fetchers = list()
+        self._bytes_held = 0
+        # the DataCache accounting for our blocks and
+        # the number of streams reading from us
+        self.owner = None
+        self.users = 0
         super(DataCacheEntry, self).__init__(path, client)
 
+    def matches(self, size, rev):
+        # whether we hold the file at rev, without
+        # a rev the size is all there is to go by
+        if rev is not None:
+            return self.rev == rev
+        return self.size == int(size)
+
+    def fetch(self):
+        # blocks are fetched on demand with ranged requests,
+        # fetching only drops whatever we already have
+        for fetcher in self._fetchers:
+            fetcher.cancel()
+        self._fetchers = list()
+        self.drop_blocks()
+        return super(DataCacheEntry, self).fetch()
+
+    def drop_blocks(self):
+        if self.owner is not None:
+            self.owner.block_removed(self, self._bytes_held)
+        self._blocks = dict()
+        self._bytes_held = 0
+        self._is_cached = False
+
+    @property
+    def bytes_held(self):
+        return self._bytes_held
+
+    @property
+    def blocks(self):
+        if self.dirty is True:
+            self.logger.info('%s found as dirty, re-fetching', self.path)
+            self.fetch()
+        return self._blocks
+
+    @property
+    def fetchers(self):
+        return self._fetchers
+
+    @property
+    def block_count(self):
+        return (self.size + DataCacheEntry.BLOCK_SIZE - 1) // DataCacheEntry.BLOCK_SIZE
+
+    def block_size(self, index):
+        return min(DataCacheEntry.BLOCK_SIZE, self.size - index * DataCacheEntry.BLOCK_SIZE)
+
+    def block_span(self, offset, size):
+        # returns the first and last blocks of [offset, offset + size)
+        # or None if the range is past the end of the file
+        end = min(offset + size, self.size)
+        if end <= offset:
+            return None
+        return offset // DataCacheEntry.BLOCK_SIZE, (end - 1) // DataCacheEntry.BLOCK_SIZE
+
+    def _has_block(self, index):
+        if index in self.blocks:
+            return True
+        if self._store is None or self.rev is None:
+            return False
+
+        data = self._store.get(self.path, self.rev, index)
+        if data is None:
+            return False
+        self.logger.debug('%s: block %d loaded from block store', os.path.basename(self.path), index)
+        DropboxMetrics.inc('dropbox_block_store_hits_total')
+        self._add_block(index, data)
+        return True
+
+    def has_range(self, offset, size):
+        span = self.block_span(offset, size)
+        if span is None:
+            return True
+        first, last = span
+        for index in xrange(first, last + 1):
+            if not self._has_block(index):
+                return False
+        return True
+
+    def read_range(self, offset, size):
+        # the range as memoryviews of the blocks holding it,
+        # nothing is copied until they are sent
+        span = self.block_span(offset, size)
+        if span is None:
+            return []
+        blocks = self.blocks
+        first, last = span
+        end = min(offset + size, self.size)
+        segments = list()
+        for index in xrange(first, last + 1):
+            block_offset = index * DataCacheEntry.BLOCK_SIZE
+            start = max(offset - block_offset, 0)
+            stop = min(end - block_offset, DataCacheEntry.BLOCK_SIZE)
+            segments.append(memoryview(blocks[index])[start:stop])
+        return segments
+
+    def missing_spans(self, offset, size):
+        # yields (first, last) runs of blocks in [offset, offset + size)
+        # that are neither cached nor being fetched
+        span = self.block_span(offset, size)
+        if span is None:
+            return
+        first, last = span
+        run_start = None
+        for index in xrange(first, last + 2):
+            missing = (index <= last) and not self._has_block(index) and not self._is_fetching(index)
+            if missing and run_start is None:
+                run_start = index
+            elif not missing and run_start is not None:
+                yield run_start, index - 1
+                run_start = None
+
+    def _is_fetching(self, index):
+        for fetcher in self._fetchers:
+            if fetcher.covers(index):
+                return True
+        return False
+
+    def set_block(self, index, data):
+        assert len(data) == self.block_size(index), 'unexpected block size'
+        if self._store is not None and self.rev is not None:
+            self._store.put(self.path, self.rev, index, data)
+        self._add_block(index, data)
+        if len(self._blocks) == self.block_count:
+            self.is_cached = True
+
+    def _add_block(self, index, data):
+        if index in self._blocks:
+            return
+        self._put_block(index, data)
+        self._bytes_held += len(data)
+        if self.owner is not None:
+            self.owner.block_added(self, len(data))
+
+    def _put_block(self, index, data):
+        self._blocks[index] = data
+
+    def fetch_blocks(self, first, last):
+        # the fetcher is started by whoever reads it
+        fetcher = DataCacheFetcher(self, first, last)
+        self._fetchers.append(fetcher)
+        return fetcher
+
+    def remove_fetcher(self, fetcher):
+        fetcher.cancel()
+        if fetcher in self._fetchers:
+            self._fetchers.remove(fetcher)
+
+
+class SharedDataCacheEntry(DataCacheEntry):
+    """
+    DataCacheEntry that keeps its blocks in a memory-mapped file, so the
+    fuse process can map the same file and read the data without copying
+    it through the stream socket.
+
+    The file starts with one byte per block set to StreamProtocol.PRESENT
+    once the block is filled, the data starts at the next page.
+    """
+    shared = True
+
+    def __init__(self, path, size, client, shared_dir, rev=None, store=None):
+        self.shared_dir = shared_dir
+        self.shm_path = None
+        self._shm = None
+        super(SharedDataCacheEntry, self).__init__(path, size, client, rev=rev, store=store)
+
+    @property
+    def shm_offset(self):
+        return (self.block_count // mmap.PAGESIZE + 1) * mmap.PAGESIZE
+
     def fetch(self):
+        super(SharedDataCacheEntry, self).fetch()
+        if self._shm is not None:
+            # kept by drop_blocks() for the streams reading us
+            return self
+        fd, self.shm_path = tempfile.mkstemp(prefix='data-', dir=self.shared_dir)
+        try:
+            os.ftruncate(fd, self.shm_offset + self.size)
+            self._shm = mmap.mmap(fd, self.shm_offset + self.size)
+        finally:
+            os.close(fd)
+        self.logger.debug('%s: mapped %s', os.path.basename(self.path), self.shm_path)
+        return self
+
+    def drop_blocks(self):
+        super(SharedDataCacheEntry, self).drop_blocks()
+        if self._shm is None:
+            return
+        if self.users > 0:
+            # the streams reading us open the file by its path, it stays
+            # until the last of them is released, without its blocks
+            self._shm[:self.block_count] = '\0' * self.block_count
+            return
+        # readers that still have it mapped keep their pages
+        self._shm.close()
+        self._shm = None
+        os.unlink(self.shm_path)
+
+    def _put_block(self, index, data):
+        offset = self.shm_offset + index * DataCacheEntry.BLOCK_SIZE
+        self._shm[offset:offset + len(data)] = data
+        # the data has to be in place before the reader sees the flag
+        self._shm[index] = StreamProtocol.PRESENT
+        self._blocks[index] = len(data)
+
+    def read_range(self, offset, size):
+        end = min(offset + size, self.size)
+        if end <= offset:
+            return []
+        return [self._shm[self.shm_offset + offset:self.shm_offset + end]]
+
+
+class DataCacheFetcher(object):
+    """
+    Ranged download of blocks first to last. The response is read by a
+    DropboxFetchPool worker with read_next() and the blocks are added to
+    the cache entry by the download server with add_block(), next_block
+    is the first block not added yet.
+    """
+    def __init__(self, dcache_entry, first, last):
+        self.logger = DropboxLogManager.get_logger(self)
+        self.dcache_entry = dcache_entry
+        self.first = first
+        self.last = last
+        self.next_block = first
+        self._next_read = first
+        self._fp = None
+        # set by the server, the worker reading us closes the response
+        self.cancelled = False
+        # the stream this fetcher reads ahead for, None for demand fetches
+        self.stream = None
+
+    def start(self):
+        dcache = self.dcache_entry
+        start = self.first * DataCacheEntry.BLOCK_SIZE
+        length = min((self.last + 1) * DataCacheEntry.BLOCK_SIZE, dcache.size) - start
+        self.logger.info('%s: fetching blocks %d-%d (%d bytes at %d)',
+                         os.path.basename(dcache.path),
+                         self.first, self.last, length, start)
         try:
-            self._fp = self.client.get_file(self.path)
-            self._fd = self._fp.fileno()
-            self._buffer = bytearray(self._fp.read(1))
-            self.logger.info('_buffer len %d self(%d) buffer(%d) rand(%d)',
-                              len(self._buffer),
-                              id(self),
-                              id(self._buffer),
-                              random.randint(0, 11111111111111111111111))
+            # the blocks have to belong to the rev of the entry, even when
+            # the file changed since
+            self._fp = dcache.client.get_file(dcache.path, rev=dcache.rev, start=start, length=length)
         except dropbox.rest.ErrorResponse as e:
             if 404 == e.status:
                 # not found
-                self.logger.error('404: %s', self.path)
+                self.logger.error('404: %s', dcache.path)
                 raise FileNotFoundError(str(e))
-            else:
-                self.logger.error('exception: %s', str(e))
-                raise
-        except AttributeError as e:
             self.logger.error('exception: %s', str(e))
-            raise
+            raise DownloadError(str(e))
+        except dropbox.rest.RESTSocketError as e:
+            self.logger.error('exception: %s', str(e))
+            raise DownloadError(str(e))
 
-        return super(DataCacheEntry, self).fetch()
+    @property
+    def done(self):
+        return self.next_block > self.last
 
     @property
-    def fp(self):
-        if self.dirty is True:
-            self.logger.info('%s found as dirty, re-fetching', self.path)
-            self.fetch()
-        return self._fp
+    def remaining_bytes(self):
+        if self.done:
+            return 0
+        dcache = self.dcache_entry
+        return min((self.last + 1) * DataCacheEntry.BLOCK_SIZE, dcache.size) - self.next_block * DataCacheEntry.BLOCK_SIZE
+
+    def covers(self, index):
+        return self.next_block <= index <= self.last
 
-    @fp.setter
-    def fp(self, value):
-        self._fp = value
+    def overlaps(self, offset, size):
+        span = self.dcache_entry.block_span(offset, size)
+        if span is None:
+            return False
+        first, last = span
+        return first <= self.last and last >= self.next_block
 
     @property
-    def buffer(self):
-        if self.dirty is True:
-            self.logger.info('%s found as dirty, re-fetching', self.path)
-            self.fetch()
-        return self._buffer
+    def read_done(self):
+        return self._next_read > self.last
 
-    @buffer.setter
-    def buffer(self, value):
-        self._buffer = value
+    def read_next(self):
+        # returns (index, data) of the next block of the response
+        if self._fp is None:
+            self.start()
+        dcache = self.dcache_entry
+        index = self._next_read
+        expected = dcache.block_size(index)
+        # a block mostly arrives in one read, it is only copied
+        # when it has to be joined
+        chunks = list()
+        length = 0
+        try:
+            while length < expected:
+                tmpbuf = self._fp.read(expected - length)
+                if not tmpbuf:
+                    break
+                chunks.append(tmpbuf)
+                length += len(tmpbuf)
+        except (HTTPError, socket.error) as e:
+            self.logger.error('exception: %s', str(e))
+            raise DownloadError(str(e))
 
-    @property
-    def fd(self):
-        if self.dirty is True:
-            self.logger.info('%s found as dirty, re-fetching', self.path)
-            self.fetch()
-            self.logger.error('change me!')
-            raise Exception('chenge me!')
-        return self._fd
+        if length != expected:
+            msg = '%s: short read on block %d: %d != %d' % (
+                os.path.basename(dcache.path), index, length, expected)
+            self.logger.error(msg)
+            raise DownloadError(msg)
+        self._next_read += 1
+        return index, chunks[0] if len(chunks) == 1 else ''.join(chunks)
+
+    def add_block(self, index, data):
+        self.dcache_entry.set_block(index, data)
+        DropboxMetrics.inc('dropbox_downloaded_bytes_total', len(data))
+        self.next_block = index + 1
 
-    @fd.setter
-    def fd(self, value):
-        self._fd = value
+    def cancel(self):
+        self.cancelled = True
+
+    def close(self):
+        if self._fp is None:
+            return
+        if not self.read_done:
+            # closing a RESTResponse drains it, drop the connection instead
+            self._fp.urllib3_response.close()
+            self._fp.urllib3_response.release_conn()
+            self._fp.is_closed = True
+        self._fp.close()
+        self._fp = None
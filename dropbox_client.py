@@ -3,11 +3,12 @@
 
 import dropbox
 from dropbox_config import DropboxConfiguration
+from dropbox_connection_pool import DropboxConnectionPool
 from dropbox_logger import DropboxLogManager
 
 
 class DropboxClient(dropbox.client.DropboxClient):
-    def __init__(self, config, app_key=None, app_secret=None, access_token=None):
+    def __init__(self, config, app_key=None, app_secret=None, access_token=None, rest_client=None):
         self.logger = DropboxLogManager.get_logger(self)
         self.config = DropboxConfiguration(config)
         if not ('app_key' in self.config and 'app_secret' in self.config):
@@ -25,7 +26,18 @@ class DropboxClient(dropbox.client.DropboxClient):
             self.config['user_id'] = user_id
 
         self.config.commit()
-        super(DropboxClient, self).__init__(self.config['access_token'])
+        if rest_client is None:
+            rest_client = DropboxConnectionPool()
+        super(DropboxClient, self).__init__(self.config['access_token'], rest_client=rest_client)
+
+    def delta_latest_cursor(self, path_prefix=None):
+        # not wrapped by the sdk, returns a cursor for the current state
+        # without listing the whole account through delta()
+        params = dict()
+        if path_prefix is not None:
+            params['path_prefix'] = path_prefix
+        url, params, headers = self.request('/delta/latest_cursor', params)
+        return self.rest_client.POST(url, params, headers)['cursor']
 
     @staticmethod
     def get_access_token(app_key, app_secret):
@@ -0,0 +1,135 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+import urlparse
+
+import urllib3
+import dropbox
+from dropbox_logger import DropboxLogManager
+from dropbox_metrics import DropboxMetrics
+
+
+class PooledConnectionsMixin(object):
+    # set by DropboxPoolManager once the pool is created
+    owner = None
+
+    def _get_conn(self, timeout=None):
+        conn = super(PooledConnectionsMixin, self)._get_conn(timeout)
+        self.owner.checkout(conn)
+        return conn
+
+    def _put_conn(self, conn):
+        if conn is not None:
+            self.owner.checkin(self, conn)
+        super(PooledConnectionsMixin, self)._put_conn(conn)
+
+
+class PooledHTTPConnectionPool(PooledConnectionsMixin, urllib3.HTTPConnectionPool):
+    pass
+
+
+class PooledHTTPSConnectionPool(PooledConnectionsMixin, urllib3.HTTPSConnectionPool):
+    pass
+
+
+class DropboxPoolManager(urllib3.PoolManager):
+    def __init__(self, owner, *args, **kwargs):
+        urllib3.PoolManager.__init__(self, *args, **kwargs)
+        self.owner = owner
+        self.pool_classes_by_scheme = dict(http=PooledHTTPConnectionPool,
+                                           https=PooledHTTPSConnectionPool)
+
+    def _new_pool(self, scheme, host, port, request_context=None):
+        pool = urllib3.PoolManager._new_pool(self, scheme, host, port, request_context)
+        pool.owner = self.owner
+        return pool
+
+
+class DropboxConnectionPool(dropbox.rest.RESTClientObject):
+    """
+    Keep-alive connections shared by all requests of a DropboxClient.
+
+    At most max_per_host connections to a host are open at a time, more
+    requests wait for one of them. Up to size of them are kept open once
+    released, and those idle for longer than idle_timeout are reconnected
+    instead of reused.
+    """
+    def __init__(self, size=8, max_per_host=16, idle_timeout=60):
+        self.logger = DropboxLogManager.get_logger(self)
+        super(DropboxConnectionPool, self).__init__(max_reusable_connections=max_per_host)
+        self.size = size
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.counters = dict()
+        self._reset(block=True)
+
+    def _reset(self, block):
+        # same ssl settings as the sdk pool manager
+        kw = dict(self.pool_manager.connection_pool_kw)
+        kw['block'] = block
+        self.pool_manager.clear()
+        self.pool_manager = DropboxPoolManager(self, num_pools=4, **kw)
+        with self.lock:
+            self.counters = dict(requests=0, hits=0, misses=0, expired=0, discarded=0)
+
+    def after_fork(self):
+        # the connections belong to the parent process. Only the fetch
+        # workers of the download server use the pool, they can wait
+        # for a connection
+        self._reset(block=True)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+    @staticmethod
+    def call_name(url):
+        # /1/metadata/auto/<path> --> metadata, /1/fileops/create_folder --> fileops/create_folder
+        parts = list()
+        for part in urlparse.urlparse(url).path.split('/')[2:4]:
+            if part in ('', 'auto', 'dropbox', 'sandbox'):
+                break
+            parts.append(part)
+        return '/'.join(parts)
+
+    def request(self, method, url, *args, **kwargs):
+        call = DropboxConnectionPool.call_name(url)
+        started = time.time()
+        try:
+            return super(DropboxConnectionPool, self).request(method, url, *args, **kwargs)
+        except dropbox.rest.ErrorResponse as e:
+            DropboxMetrics.inc('dropbox_remote_errors_total', call=call, status=e.status)
+            raise
+        except dropbox.rest.RESTSocketError:
+            DropboxMetrics.inc('dropbox_remote_errors_total', call=call, status='socket')
+            raise
+        finally:
+            DropboxMetrics.observe('dropbox_remote_request_seconds', time.time() - started, call=call)
+
+    def checkout(self, conn):
+        now = time.time()
+        with self.lock:
+            self.counters['requests'] += 1
+            last_used = getattr(conn, 'last_used', now)
+            if conn.sock is not None and now - last_used > self.idle_timeout:
+                conn.close()
+                self.counters['expired'] += 1
+            if conn.sock is None:
+                self.counters['misses'] += 1
+            else:
+                self.counters['hits'] += 1
+
+    def checkin(self, pool, conn):
+        conn.last_used = time.time()
+        queue = pool.pool
+        if queue is None or conn.sock is None:
+            return
+
+        idle = len([c for c in list(queue.queue) if c is not None and c.sock is not None])
+        if idle >= self.size:
+            conn.close()
+            with self.lock:
+                self.counters['discarded'] += 1
@@ -0,0 +1,131 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+
+import fnmatch
+import Queue
+import threading
+import time
+
+import dropbox
+from dropbox_exceptions import FileNotFoundError
+from dropbox_logger import DropboxLogManager
+
+
+class DropboxCrawlerWorker(threading.Thread):
+    def __init__(self, crawler):
+        self.logger = DropboxLogManager.get_logger(self)
+        self.crawler = crawler
+        super(DropboxCrawlerWorker, self).__init__()
+        self.daemon = True
+
+    def run(self):
+        while True:
+            job = self.crawler.queue.get()
+            try:
+                if job is None:
+                    return
+                self.crawler.visit(*job)
+            except Exception as e:
+                self.logger.exception('crawler failed: %s', str(e))
+            finally:
+                self.crawler.queue.task_done()
+
+
+class DropboxCrawler(object):
+    """
+    Walks directory trees with a pool of workers and fills the
+    MetadataCache with their listings before anyone looks them up.
+
+    max_depth limits how many levels below a root are listed, None for
+    no limit. Directories matching an exclude glob are skipped. With
+    include globs, only the matching directories, their ancestors and
+    their sub-directories are listed. Globs match the whole path, case
+    insensitive.
+    """
+    def __init__(self, mcache, workers=8, max_depth=None, include=None, exclude=None):
+        self.logger = DropboxLogManager.get_logger(self)
+        self.mcache = mcache
+        self.max_depth = max_depth
+        self.include = [p.lower() for p in include or list()]
+        self.exclude = [p.lower() for p in exclude or list()]
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.counters = dict(directories=0, entries=0, errors=0)
+        self._stop_event = threading.Event()
+        self.started = None
+        self.workers = [DropboxCrawlerWorker(self) for i in xrange(workers)]
+
+    def start(self, roots=('/', )):
+        self.started = time.time()
+        for root in roots:
+            self.queue.put((root, 0, self._matches(root)))
+        for worker in self.workers:
+            worker.start()
+        finisher = threading.Thread(target=self._finish)
+        finisher.daemon = True
+        finisher.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def join(self):
+        self.queue.join()
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def _finish(self):
+        self.queue.join()
+        for worker in self.workers:
+            self.queue.put(None)
+        self.logger.info('crawl finished in %.1fs: %s', time.time() - self.started, self.stats())
+
+    def _matches(self, path):
+        if not self.include:
+            return True
+        return any(fnmatch.fnmatch(path.lower(), pattern) for pattern in self.include)
+
+    def _excluded(self, path):
+        return any(fnmatch.fnmatch(path.lower(), pattern) for pattern in self.exclude)
+
+    def _may_contain_match(self, path):
+        # could a path below this directory match one of the include globs
+        parts = path.lower().rstrip('/').split('/')
+        for pattern in self.include:
+            pattern_parts = pattern.split('/')
+            if len(parts) < len(pattern_parts) and \
+                    all(fnmatch.fnmatch(a, b) for a, b in zip(parts, pattern_parts)):
+                return True
+        return False
+
+    def _count(self, **counts):
+        with self.lock:
+            for name, value in counts.iteritems():
+                self.counters[name] += value
+
+    def visit(self, path, depth, included):
+        if self._stop_event.is_set():
+            return
+
+        try:
+            cache_entry = self.mcache.list_directory(path)
+        except (FileNotFoundError, dropbox.rest.ErrorResponse, dropbox.rest.RESTSocketError) as e:
+            self.logger.error('failed to list %s: %s', path, str(e))
+            self._count(errors=1)
+            return
+
+        children = cache_entry.children.values() if cache_entry.listed else list()
+        self._count(directories=1, entries=len(children))
+        if self.max_depth is not None and depth >= self.max_depth:
+            return
+
+        for entry in children:
+            if entry.is_dir is not True:
+                continue
+            child = entry.path
+            if self._excluded(child):
+                continue
+            child_included = included or self._matches(child)
+            if child_included or self._may_contain_match(child):
+                self.queue.put((child, depth + 1, child_included))
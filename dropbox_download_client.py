@@ -2,10 +2,13 @@
 # -*- coding: utf-8 -*-
 
 import os
+import mmap
 import socket
+import threading
 
 from dropbox_logger import DropboxLogManager
 from dropbox_exceptions import DownloadError
+from dropbox_download_ipc import StreamProtocol
 
 
 class DropboxDownloadProxy(object):
@@ -16,6 +19,8 @@ class DropboxDownloadProxy(object):
         self.port = port
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.offset = 0
+        # one read request in flight per stream
+        self.lock = threading.Lock()
 
     def __del__(self):
         self.sock.close()
@@ -25,24 +30,85 @@ class DropboxDownloadProxy(object):
         self.sock.connect((self.addr, self.port))
         self.logger.debug('connected to %s:%d', self.addr, self.port)
 
-    def read(self, size, offset=None):
-        # offset is here just to verify that we are in order
-        if (offset is not None) and (offset != self.offset):
-            msg = 'out of order offset: %d != %d' % (offset, self.offset)
+    def _recv(self, size):
+        # received in place, the buffer is never grown
+        buf = bytearray(size)
+        view = memoryview(buf)
+        received = 0
+        while received != size:
+            count = self.sock.recv_into(view[received:])
+            if count == 0:
+                msg = '%s: stream closed by server' % (os.path.basename(self.path), )
+                self.logger.error(msg)
+                raise DownloadError(msg)
+            received += count
+        return buf
+
+    def _request(self, size, offset):
+        self.logger.debug('%s: requesting %d bytes at %d', os.path.basename(self.path), size, offset)
+        self.sock.sendall(StreamProtocol.REQUEST.pack(offset, size, StreamProtocol.READ))
+        length, = StreamProtocol.RESPONSE.unpack(str(self._recv(StreamProtocol.RESPONSE.size)))
+        if length == StreamProtocol.ERROR:
+            msg = '%s: server failed to read %d bytes at %d' % (os.path.basename(self.path), size, offset)
             self.logger.error(msg)
             raise DownloadError(msg)
+        return length
+
+    def read(self, size, offset=None):
+        with self.lock:
+            # without an offset, continue from where the last read stopped
+            if offset is None:
+                offset = self.offset
 
-        self.logger.debug('%s: recving..', os.path.basename(self.path))
-        buf = bytearray()
-        left = size
-        while left != 0:
-            tmpbuf = self.sock.recv(left)
-            if not tmpbuf:
-                break
-            buf += tmpbuf
-            left -= len(tmpbuf)
-        self.logger.debug('%s: recvd %d', os.path.basename(self.path), len(buf))
-
-        self.offset += len(buf)
+            length = self._request(size, offset)
+            buf = self._recv(length)
+            self.logger.debug('%s: recvd %d', os.path.basename(self.path), len(buf))
+
+            self.offset = offset + len(buf)
         return str(buf)
 
+
+class DropboxSharedDownloadProxy(DropboxDownloadProxy):
+    def __init__(self, path, addr, port, shm_path, shm_offset, size, block_size):
+        super(DropboxSharedDownloadProxy, self).__init__(path, addr, port)
+        self.shm_offset = shm_offset
+        self.size = size
+        self.block_size = block_size
+        fd = os.open(shm_path, os.O_RDONLY)
+        try:
+            self.shm = mmap.mmap(fd, shm_offset + size, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+
+    def __del__(self):
+        # __init__ might have failed before mapping the file
+        shm = getattr(self, 'shm', None)
+        if shm is not None:
+            shm.close()
+        super(DropboxSharedDownloadProxy, self).__del__()
+
+    def _has_range(self, offset, end):
+        for index in xrange(offset // self.block_size, (end - 1) // self.block_size + 1):
+            if self.shm[index] != StreamProtocol.PRESENT:
+                return False
+        return True
+
+    def read(self, size, offset=None):
+        with self.lock:
+            # without an offset, continue from where the last read stopped
+            if offset is None:
+                offset = self.offset
+
+            end = min(offset + size, self.size)
+            if end > offset and not self._has_range(offset, end):
+                # wait for the server to fill the missing blocks
+                self._request(size, offset)
+            else:
+                # let the server see the access pattern for its readahead
+                self.sock.sendall(StreamProtocol.REQUEST.pack(offset, size, StreamProtocol.HINT))
+
+            buf = self.shm[self.shm_offset + offset:self.shm_offset + max(end, offset)]
+            self.logger.debug('%s: read %d from shared memory', os.path.basename(self.path), len(buf))
+
+            self.offset = offset + len(buf)
+        return buf
@@ -1,56 +1,235 @@
 #!/usr/bin/python2
 # -*- coding: utf-8 -*-
 
-import cPickle
+import marshal
+import struct
 
 
-class DownloadRequest(object):
-    def __init__(self, path, size):
+def _pack_string(s):
+    if s is None:
+        return ControlProtocol.STRING.pack(-1)
+    if isinstance(s, unicode):
+        s = s.encode('utf-8')
+    return ControlProtocol.STRING.pack(len(s)) + s
+
+
+def _unpack_strings(payload, offset, count):
+    # returns the `count` strings starting at offset and the offset after them
+    strings = list()
+    for i in xrange(count):
+        length, = ControlProtocol.STRING.unpack_from(payload, offset)
+        offset += ControlProtocol.STRING.size
+        if length < 0:
+            strings.append(None)
+            continue
+        strings.append(payload[offset:offset + length])
+        offset += length
+    return strings, offset
+
+
+class ControlMessage(object):
+    # the type byte of the message on the control socket
+    TYPE = None
+
+    def pack(self):
+        return ''
+
+    @classmethod
+    def unpack(cls, payload):
+        return cls()
+
+
+class DownloadRequest(ControlMessage):
+    TYPE = 1
+    FIELDS = struct.Struct('!Q')
+
+    def __init__(self, path, size, rev=None):
         self.path = path
         self.size = size
+        self.rev = rev
 
+    def pack(self):
+        return DownloadRequest.FIELDS.pack(self.size) + _pack_string(self.path) + _pack_string(self.rev)
 
-class DownloadResponse(object):
-    def __init__(self, addr, port):
+    @classmethod
+    def unpack(cls, payload):
+        size, = cls.FIELDS.unpack_from(payload)
+        (path, rev), offset = _unpack_strings(payload, cls.FIELDS.size, 2)
+        return cls(path, size, rev)
+
+
+class DownloadResponse(ControlMessage):
+    TYPE = 2
+    # port, shm_offset, size, block_size, -1 for None
+    FIELDS = struct.Struct('!Hqqq')
+
+    def __init__(self, addr, port, shm_path=None, shm_offset=None, size=None, block_size=None):
         self.stream_addr = addr
         self.stream_port = port
+        # set when the data is served through a shared memory-mapped file
+        self.shm_path = shm_path
+        self.shm_offset = shm_offset
+        self.size = size
+        self.block_size = block_size
+
+    def pack(self):
+        fields = [-1 if value is None else value for value in (self.shm_offset, self.size, self.block_size)]
+        return (DownloadResponse.FIELDS.pack(self.stream_port, *fields) +
+                _pack_string(self.stream_addr) + _pack_string(self.shm_path))
 
+    @classmethod
+    def unpack(cls, payload):
+        fields = cls.FIELDS.unpack_from(payload)
+        port = fields[0]
+        shm_offset, size, block_size = [None if value < 0 else value for value in fields[1:]]
+        (addr, shm_path), offset = _unpack_strings(payload, cls.FIELDS.size, 2)
+        return cls(addr, port, shm_path, shm_offset, size, block_size)
 
-class DownloadShutdownRequest(object):
-    pass
 
+class DownloadShutdownRequest(ControlMessage):
+    TYPE = 3
+
+
+class DownloadCloseRequest(ControlMessage):
+    TYPE = 4
+    FIELDS = struct.Struct('!H')
 
-class DownloadCloseRequest(object):
     def __init__(self, addr, port):
         self.addr = addr
         self.port = port
 
+    def pack(self):
+        return DownloadCloseRequest.FIELDS.pack(self.port) + _pack_string(self.addr)
+
+    @classmethod
+    def unpack(cls, payload):
+        port, = cls.FIELDS.unpack_from(payload)
+        (addr, ), offset = _unpack_strings(payload, cls.FIELDS.size, 1)
+        return cls(addr, port)
+
 
-class DownloadCloseResponse(object):
-    pass
+class DownloadCloseResponse(ControlMessage):
+    TYPE = 5
+
+
+class DownloadStatsRequest(ControlMessage):
+    TYPE = 6
+
+
+class DownloadStatsResponse(ControlMessage):
+    TYPE = 7
+
+    def __init__(self, metrics):
+        # what DropboxMetrics.collect() returned in the server
+        self.metrics = metrics
+
+    def pack(self):
+        return marshal.dumps(self.metrics)
+
+    @classmethod
+    def unpack(cls, payload):
+        return cls(marshal.loads(payload))
+
+
+class DownloadErrorResponse(ControlMessage):
+    TYPE = 8
+    FIELDS = struct.Struct('!B')
+
+    def __init__(self, message, not_found=False):
+        self.message = message
+        # the server has no such file
+        self.not_found = not_found
+
+    def __str__(self):
+        return self.message
+
+    def pack(self):
+        return DownloadErrorResponse.FIELDS.pack(self.not_found) + _pack_string(self.message)
+
+    @classmethod
+    def unpack(cls, payload):
+        not_found, = cls.FIELDS.unpack_from(payload)
+        (message, ), offset = _unpack_strings(payload, cls.FIELDS.size, 1)
+        return cls(message, bool(not_found))
+
+
+class ControlProtocol(object):
+    # frame length, the frame holds a batch of messages
+    FRAME = struct.Struct('!I')
+    # request id, message type, payload length
+    MESSAGE = struct.Struct('!IBI')
+    # string length, -1 for None
+    STRING = struct.Struct('!i')
+    MESSAGES = dict((cls.TYPE, cls) for cls in (DownloadRequest, DownloadResponse,
+                                                 DownloadShutdownRequest,
+                                                 DownloadCloseRequest, DownloadCloseResponse,
+                                                 DownloadStatsRequest, DownloadStatsResponse,
+                                                 DownloadErrorResponse))
+
+
+class StreamProtocol(object):
+    # proxy --> server: offset, size, flags
+    REQUEST = struct.Struct('!QIB')
+    # a read the proxy waits on
+    READ = 0
+    # a read the proxy already served itself, no response is sent
+    HINT = 1
+    # server --> proxy: length of the data that follows, ERROR on failure
+    RESPONSE = struct.Struct('!i')
+    ERROR = -1
+    # marks a filled block in the bitmap of a shared memory-mapped file
+    PRESENT = '\x01'
 
 
 class ControlSocket(object):
-    BUFSIZE = 1024
+    """
+    Sends and receives batches of (request id, message) over a stream
+    socket, one frame per batch. The socket stays blocking, the server
+    only calls recv() once poll() found it readable.
+    """
+    BUFSIZE = 64 * 1024
 
     def __init__(self, sock):
         self.sock = sock
+        # what arrived of the next frames
+        self.buf = ''
 
     def __del__(self):
         self.sock.close()
 
-    def send(self, msg):
-        msg = cPickle.dumps(msg)
-        self.sock.sendall(msg)
+    def send(self, batch):
+        parts = list()
+        for req_id, msg in batch:
+            payload = msg.pack()
+            parts.append(ControlProtocol.MESSAGE.pack(req_id, msg.TYPE, len(payload)))
+            parts.append(payload)
+        frame = ''.join(parts)
+        self.sock.sendall(ControlProtocol.FRAME.pack(len(frame)) + frame)
 
     def recv(self):
-        msg = self.sock.recv(ControlSocket.BUFSIZE)
-        msg = cPickle.loads(msg)
-        return msg
+        # the messages of the frames that are complete now,
+        # None once the other side closed the socket
+        data = self.sock.recv(ControlSocket.BUFSIZE)
+        if not data:
+            return None
+        self.buf += data
+
+        batch = list()
+        offset = 0
+        while len(self.buf) - offset >= ControlProtocol.FRAME.size:
+            length, = ControlProtocol.FRAME.unpack_from(self.buf, offset)
+            end = offset + ControlProtocol.FRAME.size + length
+            if len(self.buf) < end:
+                break
+            offset += ControlProtocol.FRAME.size
+            while offset < end:
+                req_id, kind, size = ControlProtocol.MESSAGE.unpack_from(self.buf, offset)
+                offset += ControlProtocol.MESSAGE.size
+                msg = ControlProtocol.MESSAGES[kind].unpack(self.buf[offset:offset + size])
+                batch.append((req_id, msg))
+                offset += size
+        self.buf = self.buf[offset:]
+        return batch
 
     def fileno(self):
         return self.sock.fileno()
-
-    def setblocking(self, mode):
-        return self.sock.setblocking(mode)
-
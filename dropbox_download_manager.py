@@ -2,28 +2,161 @@
 # -*- coding: utf-8 -*-
 
 import socket
+import threading
 
 from dropbox_logger import DropboxLogManager
-from dropbox_exceptions import DownloadError
+from dropbox_exceptions import FileNotFoundError, DownloadError
 from dropbox_cache import CacheManager
 from dropbox_download_ipc import ControlSocket, DownloadShutdownRequest
 from dropbox_download_ipc import DownloadRequest, DownloadResponse
 from dropbox_download_ipc import DownloadCloseRequest, DownloadCloseResponse
+from dropbox_download_ipc import DownloadStatsRequest, DownloadStatsResponse
+from dropbox_download_ipc import DownloadErrorResponse
 from dropbox_download_server import DropboxDownloadServer
-from dropbox_download_client import DropboxDownloadProxy
+from dropbox_download_client import DropboxDownloadProxy, DropboxSharedDownloadProxy
+from dropbox_utils import HashRing
+
+
+class ControlRequest(object):
+    """
+    A request in flight to a download server, wait() returns the
+    response, `callback` is called with it instead when given
+    """
+    def __init__(self, msg, callback=None):
+        self.msg = msg
+        self.callback = callback
+        self.response = None
+        self.done = threading.Event()
+
+    def complete(self, response):
+        self.response = response
+        self.done.set()
+        if self.callback is not None:
+            self.callback(response)
+
+    def wait(self):
+        self.done.wait()
+        return self.response
+
+
+class DropboxDownloadShard(object):
+    """
+    One download server process and the control socket to it.
+
+    Requests carry an id, so any number of them can be in flight, the
+    responses are handed to them by a receiver thread. Requests queued
+    while a frame is being sent go out together in the next one.
+    """
+    def __init__(self, dbclient, index, count, **server_options):
+        self.logger = DropboxLogManager.get_logger(self)
+        self.index = index
+        server_sock, client_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.control_sock = ControlSocket(client_sock)
+        # request id --> ControlRequest waiting for its response
+        self.pending = dict()
+        # (request id, message) not sent yet
+        self.outgoing = list()
+        self.next_id = 0
+        self.closed = False
+        # guards pending, outgoing, next_id and closed
+        self.lock = threading.Lock()
+        # one frame at a time on the control socket
+        self.send_lock = threading.Lock()
+        self.server = DropboxDownloadServer(dbclient, ControlSocket(server_sock), **server_options)
+        if count > 1:
+            self.server.name = 'download_server_%d' % (index, )
+        else:
+            self.server.name = 'download_server'
+        self.server.start()
+        # the server holds its end now, we see it closed when it dies
+        server_sock.close()
+        self.server.control_sock = None
+        self.receiver = threading.Thread(target=self._receive, name='%s_control' % (self.server.name, ))
+        self.receiver.daemon = True
+        self.receiver.start()
+
+    def _receive(self):
+        while True:
+            try:
+                batch = self.control_sock.recv()
+            except socket.error as e:
+                self.logger.error('control socket: %s', str(e))
+                batch = None
+            if batch is None:
+                break
+            for req_id, resp in batch:
+                with self.lock:
+                    request = self.pending.pop(req_id, None)
+                if request is None:
+                    self.logger.error('response to unknown request %d', req_id)
+                    continue
+                request.complete(resp)
+
+        with self.lock:
+            self.closed = True
+            pending, self.pending = self.pending, dict()
+        for request in pending.itervalues():
+            request.complete(DownloadErrorResponse('%s is gone' % (self.server.name, )))
+
+    def _flush(self):
+        # whoever gets to send takes everything queued so far
+        with self.send_lock:
+            with self.lock:
+                batch, self.outgoing = self.outgoing, list()
+            if batch:
+                self.control_sock.send(batch)
+
+    def submit(self, msg, callback=None):
+        request = ControlRequest(msg, callback)
+        with self.lock:
+            closed = self.closed
+            if not closed:
+                req_id = self.next_id
+                self.next_id = (self.next_id + 1) & 0xffffffff
+                self.pending[req_id] = request
+                self.outgoing.append((req_id, msg))
+        if closed:
+            request.complete(DownloadErrorResponse('%s is gone' % (self.server.name, )))
+        else:
+            self._flush()
+        return request
+
+    def request(self, msg):
+        return self.submit(msg).wait()
+
+    def shutdown(self):
+        if not self.server.is_alive():
+            return
+        self.logger.critical('shutting down server: sending shutdown request')
+        # no response to this one
+        with self.lock:
+            self.outgoing.append((0, DownloadShutdownRequest()))
+        self._flush()
+        self.logger.critical('waiting for server')
+        self.server.join()
+        self.logger.critical('server died, RIP')
 
 
 class DropboxDownloadManager(object):
-    def __init__(self, dbclient):
+    """
+    Starts `servers` download server processes, every file is served by
+    the one its path hashes to, so its cached data lives in one process.
+    `stores` are the block stores of the servers, one each.
+    """
+    def __init__(self, dbclient, servers=1, stores=None, **server_options):
         self.logger = DropboxLogManager.get_logger(self)
         self.dbclient = dbclient
-        server_sock, client_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
-        self.control_sock = ControlSocket(client_sock)
         self.mcache = CacheManager.get_cache('MetadataCache')
         self.downloads = dict()
         self.next_fd = 0
-        self.server = DropboxDownloadServer(self.dbclient, ControlSocket(server_sock))
-        self.server.start()
+        # guards downloads and next_fd
+        self.lock = threading.Lock()
+        self.ring = HashRing(servers)
+        self.shards = list()
+        for index in xrange(servers):
+            if stores is not None:
+                server_options['store'] = stores[index]
+            self.shards.append(DropboxDownloadShard(self.dbclient, index, servers, **server_options))
 
     def __del__(self):
         self.shutdown_server()
@@ -31,36 +164,59 @@ class DropboxDownloadManager(object):
     def download_by_fd(self, fd):
         return self.downloads.get(fd)
 
+    def shard_by_path(self, path):
+        return self.shards[self.ring.get(path.lower())]
+
     def shutdown_server(self):
-        self.logger.critical('shutting down server: sending shutdown request')
-        msg = DownloadShutdownRequest()
-        self.control_sock.send(msg)
-        self.logger.critical('waiting for server')
-        self.server.join()
-        self.logger.critical('server died, RIP')
+        for shard in self.shards:
+            shard.shutdown()
+
+    def stats(self):
+        # server name --> the metrics of that server, see DropboxMetrics.collect()
+        stats = dict()
+        for shard in self.shards:
+            resp = shard.request(DownloadStatsRequest())
+            if not isinstance(resp, DownloadStatsResponse):
+                self.logger.error('expected DownloadStatsResponse, got %s', str(resp))
+                raise DownloadError('stats')
+            stats[shard.server.name] = resp.metrics
+        return stats
+
+    def load(self):
+        # open files per server
+        load = [0] * len(self.shards)
+        with self.lock:
+            for download in self.downloads.itervalues():
+                load[self.ring.get(download.path.lower())] += 1
+        return load
 
     def open_file(self, remote_path):
         self.logger.info('open remote file %s', remote_path)
-        mcache_entry = self.mcache.get_entry(remote_path)
+        mcache_entry = self.mcache.get_entry(remote_path).refresh()
         # request the server to give us a data pipe handle
         # for the file `remote_path` with this expected size
         # in order to detect cache inconsistency
-        msg = DownloadRequest(remote_path, mcache_entry.metadata['bytes'])
-        self.control_sock.send(msg)
-
-        #TODO: maybe use poll() or just verify that the server is alive
-        resp = self.control_sock.recv()
+        msg = DownloadRequest(remote_path, mcache_entry.size, mcache_entry.rev)
+        resp = self.shard_by_path(remote_path).request(msg)
+        if isinstance(resp, DownloadErrorResponse) and resp.not_found:
+            raise FileNotFoundError(resp.message)
         if not isinstance(resp, DownloadResponse):
             self.logger.error('expected DownloadResponse, got %s', str(resp))
             raise DownloadError(remote_path)
 
         self.logger.info('got DownloadResponse: %s:%d', resp.stream_addr, resp.stream_port)
-        proxy = DropboxDownloadProxy(remote_path, resp.stream_addr, resp.stream_port)
+        if resp.shm_path is not None:
+            proxy = DropboxSharedDownloadProxy(remote_path, resp.stream_addr, resp.stream_port,
+                                               resp.shm_path, resp.shm_offset,
+                                               resp.size, resp.block_size)
+        else:
+            proxy = DropboxDownloadProxy(remote_path, resp.stream_addr, resp.stream_port)
         proxy.connect()
 
-        fd = int(self.next_fd)
-        self.downloads[fd] = proxy
-        self.next_fd += 1
+        with self.lock:
+            fd = int(self.next_fd)
+            self.downloads[fd] = proxy
+            self.next_fd += 1
         self.logger.debug('allocated fd %d', fd)
         return fd
 
@@ -74,13 +230,12 @@ class DropboxDownloadManager(object):
 
         self.logger.info('sending DownloadCloseRequest for %s:%d', download.addr, download.port)
         msg = DownloadCloseRequest(download.addr, download.port)
-        self.control_sock.send(msg)
+        with self.lock:
+            del self.downloads[fd]
+        # nothing waits for the stream to go away
+        self.shard_by_path(download.path).submit(msg, callback=self._closed)
+        del download
 
-        #TODO: maybe use poll() or just verify that the server is alive
-        resp = self.control_sock.recv()
+    def _closed(self, resp):
         if not isinstance(resp, DownloadCloseResponse):
             self.logger.error('failed to close remote file: %s', str(resp))
-            raise DownloadError(str(resp))
-
-        del self.downloads[fd]
-        del download
@@ -2,18 +2,23 @@
 # -*- coding: utf-8 -*-
 
 import os
+import errno
 import select
+import socket
 from multiprocessing import Process
-from urllib3.exceptions import HTTPError
 
 from dropbox_logger import DropboxLogManager
-from dropbox_exceptions import StreamReadBlock
-from dropbox_cache import DataCache
-from dropbox_exceptions import FileNotFoundError
+from dropbox_metrics import DropboxMetrics
+from dropbox_cache import CacheManager, DataCacheEntry
+from dropbox_exceptions import FileNotFoundError, DownloadError
 from dropbox_download_ipc import DownloadShutdownRequest
 from dropbox_download_ipc import DownloadRequest
 from dropbox_download_ipc import DownloadCloseRequest, DownloadCloseResponse
+from dropbox_download_ipc import DownloadStatsRequest, DownloadStatsResponse
+from dropbox_download_ipc import DownloadErrorResponse
+from dropbox_download_ipc import StreamProtocol
 from dropbox_download_stream import DownloadStream
+from dropbox_fetch_pool import DropboxFetchPool
 
 
 class DropboxDownloadServer(Process):
@@ -21,14 +26,28 @@ class DropboxDownloadServer(Process):
     READ_ONLY = select.POLLIN | select.POLLPRI | ERR_ONLY
     WRITE_ONLY = select.POLLOUT | ERR_ONLY
     READ_WRITE = READ_ONLY | WRITE_ONLY
-    BUFSIZE = 4 * 1024 * 1024
 
-    def __init__(self, dbclient, control_sock):
+    def __init__(self, dbclient, control_sock, readahead=32 * 1024 * 1024, readahead_total=256 * 1024 * 1024,
+                 fetch_workers=8, store=None):
         self.logger = DropboxLogManager.get_logger(self)
         self.dbclient = dbclient
         self.control_sock = control_sock
-        self.dcache = DataCache(self.dbclient)
-        self.streams = list()
+        # block store of this server, when servers don't share one
+        self.store = store
+        # readahead window limit per stream and for all streams together
+        self.readahead = readahead
+        self.readahead_total = readahead_total
+        self.dcache = CacheManager.get_cache('DataCache')
+        # (addr, port) the proxy connected to --> stream
+        self.streams = dict()
+        # data cache entry --> streams reading it
+        self.dcache_streams = dict()
+        self.fetchers = set()
+        # bytes the readahead fetchers have yet to read
+        self.prefetching = 0
+        # started in run(), the threads have to live in our process
+        self.fetch_workers = fetch_workers
+        self.fetch_pool = None
 
         # for poll()
         self.output_fds = dict()
@@ -75,114 +94,229 @@ class DropboxDownloadServer(Process):
     def _socket_by_output_fd(self, fd):
         return self.output_fds.get(fd)
 
-    def _dcache_by_dropbox_fd(self, fd):
-        dcaches = map(lambda x: x.dcache_entry, self.streams)
-        for dcache in dcaches:
-            if dcache.fd == fd:
-                return dcache
-
     def _stream_by_proxy_port(self, addr, port):
-        for stream in self.streams:
-            s_addr, s_port = stream.server_sock.getsockname()
-            if (s_addr == addr) and (s_port == port):
-                return stream
+        return self.streams.get((addr, port))
 
     def _stream_by_proxy_client_fd(self, fd):
-        sock = self._socket_by_output_fd(fd)
-        for stream in self.streams:
-            if stream.client_sock == sock:
-                return stream
+        stream = self.input_fds.get(fd)
+        if isinstance(stream, DownloadStream):
+            return stream
 
-    def _streams_by_fp(self, fp):
-        for stream in self.streams:
-            if stream.dcache_entry.fp is fp:
-                yield stream
+    def _streams_by_dcache(self, dcache):
+        return list(self.dcache_streams.get(dcache, ()))
 
     def _register_stream(self, stream):
         # assumes that the client socket of the stream
         # is already connected
         self.logger.info('registering stream for %s', os.path.basename(stream.path))
-        # make sure the stream fp is accounted for
-        if stream.dcache_entry.is_cached is False:
-            self._register_input_fd(stream.dcache_entry.fp)
-        else:
-            # set the stream as readable if the file is fully cached
-            stream.is_readable = True
+        # the entry was acquired by get_entry(), it is not evicted
+        # while the stream reads it
         self._register_input_fd(stream)
 
-        self.streams.append(stream)
-        self.logger.debug('current streams: %s', str(self.streams))
+        self.streams[stream.address] = stream
+        self.dcache_streams.setdefault(stream.dcache_entry, list()).append(stream)
+        self.logger.debug('current streams: %d', len(self.streams))
         return stream
 
     def _unregister_stream(self, stream):
         self.logger.info('un-registering stream for %s', os.path.basename(stream.path))
-        self.streams.remove(stream)
+        del self.streams[stream.address]
+        streams = self.dcache_streams[stream.dcache_entry]
+        streams.remove(stream)
+        if not streams:
+            del self.dcache_streams[stream.dcache_entry]
 
         fd = stream.fileno()
         self._unregister_fd(fd)
+        for fetcher in list(stream.prefetchers):
+            self._cancel_fetcher(fetcher)
+        self.dcache.release(stream.dcache_entry)
+        self.logger.debug('current streams: %d', len(self.streams))
+
+    def _register_fetcher(self, fetcher):
+        self.fetchers.add(fetcher)
+        if fetcher.stream is not None:
+            self.prefetching += fetcher.remaining_bytes
+        self.fetch_pool.submit(fetcher)
+        self.logger.debug('current fetchers: %d', len(self.fetchers))
+
+    def _unregister_fetcher(self, fetcher):
+        self.fetchers.remove(fetcher)
+        fetcher.dcache_entry.remove_fetcher(fetcher)
+        if fetcher.stream is not None:
+            self.prefetching -= fetcher.remaining_bytes
+            fetcher.stream.prefetchers.remove(fetcher)
+            fetcher.stream = None
+        self.logger.debug('current fetchers: %d', len(self.fetchers))
+
+    def _cancel_fetcher(self, fetcher):
+        self.logger.info('cancelling fetch of blocks %d-%d of %s',
+                         fetcher.next_block, fetcher.last,
+                         os.path.basename(fetcher.dcache_entry.path))
+        self._unregister_fetcher(fetcher)
+        # streams that waited on it have to fetch the blocks themselves
+        for stream in self._streams_by_dcache(fetcher.dcache_entry):
+            self._serve_stream(stream)
+
+    def _update_readahead(self, stream, offset, size):
+        if offset == stream.next_offset:
+            # sequential, grow the window up to the per stream limit
+            stream.readahead = min(max(2 * stream.readahead, DataCacheEntry.BLOCK_SIZE), self.readahead)
+        else:
+            if stream.readahead > 0:
+                self.logger.info('%s: random access, dropping readahead', os.path.basename(stream.path))
+            stream.readahead = 0
+            for fetcher in list(stream.prefetchers):
+                if not fetcher.overlaps(offset, size):
+                    self._cancel_fetcher(fetcher)
+        stream.next_offset = offset + size
+
+    def _prefetch(self, stream):
+        size = min(stream.readahead, self.readahead_total - self.prefetching)
+        if size <= 0:
+            return
 
-        fp = stream.dcache_entry.fp
-        fd = stream.dcache_entry.fd
-        streams_with_fp = list(self._streams_by_fp(fp))
-        if len(streams_with_fp) == 0:
-            self._unregister_fd(fd)
-        self.logger.debug('current streams: %s', str(self.streams))
+        dcache = stream.dcache_entry
+        spans = list(dcache.missing_spans(stream.next_offset, size))
+        if not spans:
+            return
+        # refill once half of the window was consumed, so the window
+        # goes out in a few large requests instead of one per block
+        if spans[0][0] * DataCacheEntry.BLOCK_SIZE > stream.next_offset + size / 2:
+            return
+
+        for first, last in spans:
+            fetcher = dcache.fetch_blocks(first, last)
+            fetcher.stream = stream
+            stream.prefetchers.append(fetcher)
+            self._register_fetcher(fetcher)
 
     def _serve_request(self, req):
+        # returns the response to send back
         if isinstance(req, DownloadRequest):
             self.logger.info('serving DownloadRequest for %s', req.path)
             try:
-                dcache_entry = self.dcache.get_entry(req.path, size=req.size)
+                dcache_entry = self.dcache.get_entry(req.path, size=req.size, rev=req.rev, acquire=True)
             except FileNotFoundError as e:
-                # ditch the request and send the client the exception
+                # ditch the request and send the client the error
                 self.logger.error('404: %s', str(e))
-                self.control_sock.send(e)
-                return
+                return DownloadErrorResponse(str(e), not_found=True)
 
-            stream = DownloadStream(req.path, dcache_entry)
-            resp = stream.prepare_response()
-            self.control_sock.send(resp)
-            stream.accept_connection()
+            # the connection of the proxy is accepted once poll() finds it
+            try:
+                stream = DownloadStream(req.path, dcache_entry)
+            except socket.error:
+                self.dcache.release(dcache_entry)
+                raise
             self._register_stream(stream)
+            return stream.prepare_response()
 
         elif isinstance(req, DownloadCloseRequest):
             self.logger.info('serving DownloadCloseRequest for %s:%d', req.addr, req.port)
-            self.control_sock.send(DownloadCloseResponse())
             stream = self._stream_by_proxy_port(req.addr, req.port)
+            if stream is None:
+                return DownloadErrorResponse('no stream for %s:%d' % (req.addr, req.port))
             self._unregister_stream(stream)
             del stream
+            return DownloadCloseResponse()
+
+        elif isinstance(req, DownloadStatsRequest):
+            return DownloadStatsResponse(DropboxMetrics.collect())
+
+        return DownloadErrorResponse('unexpected request %s' % (type(req).__name__, ))
+
+    def _serve_requests(self):
+        # serves a batch of requests, returns False on shutdown
+        batch = self.control_sock.recv()
+        if batch is None:
+            self.logger.critical('control socket closed, shutting down server!')
+            return False
+
+        responses = list()
+        shutdown = False
+        for req_id, req in batch:
+            if isinstance(req, DownloadShutdownRequest):
+                self.logger.critical('got DownloadShutdownRequest, shutting down server!')
+                shutdown = True
+                break
+            try:
+                response = self._serve_request(req)
+            except (socket.error, IOError, OSError) as e:
+                self.logger.error('failed to serve %s: %s', type(req).__name__, str(e))
+                response = DownloadErrorResponse(str(e))
+            responses.append((req_id, response))
+
+        # the responses of a batch go back in one frame
+        if responses:
+            self.control_sock.send(responses)
+        return not shutdown
+
+    def _drop_stream(self, stream, error):
+        # a failed stream does not take the others down with it
+        self.logger.error('%s: dropping stream: %s', os.path.basename(stream.path), str(error))
+        if self.streams.get(stream.address) is stream:
+            self._unregister_stream(stream)
+        else:
+            self._unregister_fd(stream.fileno())
+        # the proxy sees the connection go away instead of waiting
+        stream.close()
+
+    def _accept_stream(self, stream):
+        # the proxy connected, poll the connection instead of the listening socket
+        self._unregister_fd(stream.fileno())
+        stream.accept_connection()
+        self._register_input_fd(stream)
 
-    def _handle_dcache_loop(self, fd):
-        dcache = self._dcache_by_dropbox_fd(fd)
-        # fill the cache buffer from network
-        if dcache.fp is None:
-            self.logger.warn('found dcache with no fp in dcache loop')
+    def _serve_stream(self, stream):
+        if stream.pending_request is None:
             return
 
-        self.logger.info('recving from %s',
-                         os.path.basename(dcache.path))
-        try:
-            buf = dcache.fp.read(DropboxDownloadServer.BUFSIZE)
-            if 0 == len(buf):
-                self.logger.info('finised downloading %s', os.path.basename(dcache.path))
-                self.logger.info('removing from input fds..')
-                self._unregister_fd(fd)
-                dcache.is_cached = True
-                return
-
-            self.logger.info('recvd %d from %s',
-                             len(buf),
-                             os.path.basename(dcache.path))
-        except HTTPError as e:
-            self.logger.error('exception: %s', str(e))
+        offset, size = stream.pending_request
+        dcache = stream.dcache_entry
+        if dcache.has_range(offset, size):
+            stream.send_range(offset, size)
+            return
+
+        # fetch only the missing blocks, the stream is served
+        # once the fetchers filled them
+        for first, last in dcache.missing_spans(offset, size):
+            self._register_fetcher(dcache.fetch_blocks(first, last))
+
+    def _handle_fetches(self):
+        for fetcher, index, result in self.fetch_pool.completed():
+            # blocks of cancelled fetchers are dropped
+            if fetcher not in self.fetchers:
+                continue
+            if fetcher.cancelled:
+                # the cache entry dropped its blocks, or the
+                # pool closed it and tells us with a None result
+                self._unregister_fetcher(fetcher)
+                continue
+            self._handle_fetcher(fetcher, index, result)
+
+    def _handle_fetcher(self, fetcher, index, result):
+        dcache = fetcher.dcache_entry
+        if isinstance(result, Exception):
+            self.logger.error('failed to fetch %s: %s', os.path.basename(dcache.path), str(result))
+            for stream in self._streams_by_dcache(dcache):
+                if stream.pending_request is not None and fetcher.overlaps(*stream.pending_request):
+                    stream.send_error()
+            self._unregister_fetcher(fetcher)
             return
 
-        dcache.buffer += buf
-        # iterate over the streams related to the current fp
-        for stream in self._streams_by_fp(dcache.fp):
-            # if the stream is a `FakeFileObject`, trigger it
-            if hasattr(stream, 'is_readable'):
-                stream.is_readable = True
+        self.logger.debug('recvd block %d of %s', index, os.path.basename(dcache.path))
+        fetcher.add_block(index, result)
+        if fetcher.stream is not None:
+            self.prefetching -= len(result)
+
+        if fetcher.done:
+            self.logger.info('finished fetching blocks %d-%d of %s',
+                             fetcher.first, fetcher.last,
+                             os.path.basename(dcache.path))
+            self._unregister_fetcher(fetcher)
+
+        for stream in self._streams_by_dcache(dcache):
+            self._serve_stream(stream)
 
     def _handle_client_stream(self, fd):
         stream = self.input_fds.get(fd)
@@ -191,32 +325,57 @@ class DropboxDownloadServer(Process):
             return
 
         try:
-            buf = stream.read(DropboxDownloadServer.BUFSIZE)
-        except StreamReadBlock as e:
-            # we will try next time
-            return
+            request = stream.recv_request()
+        except (socket.error, DownloadError) as e:
+            self.logger.error('%s: bad read request: %s', os.path.basename(stream.path), str(e))
+            request = None
 
-        if not buf:
-            self.logger.info('finised uploading %s to proxy', os.path.basename(stream.path))
+        if request is None:
+            self.logger.info('proxy closed stream for %s', os.path.basename(stream.path))
             self.logger.info('removing from input fds..')
             self._unregister_fd(fd)
-            stream.client_sock.close()
             return
 
-        sent = stream.client_sock.send(buf)
-        self.logger.debug('sent %d bytes to client, buf len %d', sent, len(buf))
-        if sent != len(buf):
-            self.logger.ERROR('sent != len(buf) -- %d != %d', sent, len(buf))
+        offset, size, flags = request
+        if flags & StreamProtocol.HINT:
+            result = 'local'
+        elif stream.dcache_entry.has_range(offset, size):
+            result = 'hit'
+        else:
+            result = 'miss'
+        DropboxMetrics.inc('dropbox_read_requests_total', result=result)
+        self._update_readahead(stream, offset, size)
+        self._serve_stream(stream)
+        self._prefetch(stream)
+
+    def _register_gauges(self):
+        DropboxMetrics.reset()
+        DropboxMetrics.gauge('dropbox_active_streams', lambda: len(self.streams))
+        DropboxMetrics.gauge('dropbox_active_fetchers', lambda: len(self.fetchers))
+        DropboxMetrics.gauge('dropbox_fetch_queue', lambda: self.fetch_pool.pending())
+        DropboxMetrics.gauge('dropbox_data_cache_bytes', lambda: self.dcache.bytes_held)
+        DropboxMetrics.gauge('dropbox_cpu_seconds', lambda: sum(os.times()[:2]))
 
     def run(self):
+        self.dbclient.rest_client.after_fork()
+        if self.store is not None:
+            self.dcache.store = self.store
+        self.fetch_pool = DropboxFetchPool(workers=self.fetch_workers)
+        self._register_input_fd(self.fetch_pool)
+        self._register_gauges()
         while True:
-            self.logger.info('waiting for events..')
+            self.logger.debug('waiting for events..')
             self.logger.debug('entering poll()')
-            events = self.poller.poll()
+            try:
+                events = self.poller.poll()
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
             self.logger.debug('exited poll()')
 
             for fd, flags in events:
-                self.logger.info('got fd %d flags %d', fd, flags)
+                self.logger.debug('got fd %d flags %d', fd, flags)
                 sock = self._socket_by_input_fd(fd)
                 if flags & (select.POLLHUP | select.POLLERR | select.POLLNVAL):
                     self.logger.warn('poll() detected err on fd %d flags %d', fd, flags)
@@ -228,16 +387,20 @@ class DropboxDownloadServer(Process):
                     self.poller.unregister(fd)
                 elif flags & (select.POLLIN | select.POLLPRI):
                     if self.control_sock is sock:
-                        req = self.control_sock.recv()
-                        if isinstance(req, DownloadShutdownRequest):
-                            self.logger.critical('got DownloadShutdownRequest, shutting down server!')
+                        if not self._serve_requests():
+                            self.logger.info('connection pool: %s', self.dbclient.rest_client.stats())
+                            self.fetch_pool.shutdown()
+                            DropboxLogManager.flush()
                             return
-                        self._serve_request(req)
-                    else:
-                        obj = self.input_fds.get(fd)
-                        if isinstance(obj, DownloadStream):
-                            self._handle_client_stream(fd)
-                        else:
-                            self._handle_dcache_loop(fd)
+                    elif self.fetch_pool is sock:
+                        self._handle_fetches()
+                    elif isinstance(sock, DownloadStream):
+                        try:
+                            if sock.client_sock is None:
+                                self._accept_stream(sock)
+                            else:
+                                self._handle_client_stream(fd)
+                        except (socket.error, IOError, OSError, DownloadError) as e:
+                            self._drop_stream(sock, e)
                 elif flags & select.POLLOUT:
                     pass
@@ -2,15 +2,15 @@
 # -*- coding: utf-8 -*-
 
 import os
+import errno
 import socket
 
 from dropbox_logger import DropboxLogManager
-from dropbox_exceptions import DownloadError, StreamReadBlock
-from dropbox_download_ipc import DownloadResponse
-from dropbox_utils import FakeFileObject
+from dropbox_exceptions import DownloadError
+from dropbox_download_ipc import DownloadResponse, StreamProtocol
 
 
-class DownloadStream(FakeFileObject):
+class DownloadStream(object):
     def __init__(self, path, dcache_entry):
         self.logger = DropboxLogManager.get_logger(self)
         self.path = path
@@ -22,66 +22,115 @@ class DownloadStream(FakeFileObject):
         # the socket is created, binded and listen(1)
         # the the addr, port is passed to the client process
         # the client will try to connect() and will be catched by the backlog
-        # then we (our process) will hit accept() and finish the handshake
+        # then poll() finds the socket readable and we accept() to finish the handshake
         self.server_sock.listen(1)
+        # the proxy refers to the stream by the address it connected to
+        self.address = self.server_sock.getsockname()
         self.client_sock = None
         self.client_addr = None
-        self.client_pos = 0
+        self._fileno = None
+        # (offset, size) of the read request we are waiting to serve
+        self.pending_request = None
+        # readahead state, see DropboxDownloadServer._update_readahead
+        self.next_offset = 0
+        self.readahead = 0
+        self.prefetchers = list()
         self.logger.info('created stream (%d) for %s', id(self), os.path.basename(self.path))
-        super(DownloadStream, self).__init__()
 
     def __del__(self):
+        self.close()
+        self.logger.info('closed stream (%d) for %s', id(self), os.path.basename(self.path))
+
+    def close(self):
         if self.server_sock is not None:
             self.server_sock.close()
+            self.server_sock = None
         if self.client_sock is not None:
             self.client_sock.close()
-        self.logger.info('closed stream (%d) for %s', id(self), os.path.basename(self.path))
+            self.client_sock = None
+
+    def fileno(self):
+        if self.client_sock is None:
+            # polled for the connection of the proxy until it is accepted
+            return self.server_sock.fileno()
+        return self._fileno
 
     def accept_connection(self):
         self.logger.info('Accepting connection for %s', os.path.basename(self.path))
-        client_sock, addr = self.server_sock.accept()
+        while True:
+            try:
+                client_sock, addr = self.server_sock.accept()
+                break
+            except socket.error as e:
+                if e.errno != errno.EINTR:
+                    raise
+        # a response goes out in several sends, don't hold back the last one
+        client_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.client_sock = client_sock
         self.client_addr = addr
+        self._fileno = client_sock.fileno()
+        # one connection per stream, don't hold a descriptor for listening
+        self.server_sock.close()
+        self.server_sock = None
         self.logger.info('Accepted connection')
 
     def prepare_response(self):
-        addr, port = self.server_sock.getsockname()
+        addr, port = self.address
+        dcache = self.dcache_entry
+        if dcache.shared:
+            return DownloadResponse(addr, port,
+                                    shm_path=dcache.shm_path,
+                                    shm_offset=dcache.shm_offset,
+                                    size=dcache.size,
+                                    block_size=dcache.BLOCK_SIZE)
         return DownloadResponse(addr, port)
 
-    def read(self, size):
-        self.logger.debug('%s: read size %d', self.path, size)
-        # first, set stream as EWOULDBLOCK
-        self.is_readable = False
-        # non blocking read from dcache buffer
-        # reads from dcache.buffer only, not from dcache.fp
-        if self.dcache_entry.dirty is True:
-            msg = '%s: dcache indicates its dirty, cancelling stream' % (os.path.basename(self.path), )
-            self.logger.warn(msg)
+    def recv_request(self):
+        # returns (offset, size, flags) or None when the proxy closed its side of the stream
+        buf = ''
+        while len(buf) < StreamProtocol.REQUEST.size:
+            tmpbuf = self.client_sock.recv(StreamProtocol.REQUEST.size - len(buf))
+            if not tmpbuf:
+                return None
+            buf += tmpbuf
+
+        offset, size, flags = StreamProtocol.REQUEST.unpack(buf)
+        self.logger.debug('%s: read request offset %d size %d flags %d',
+                          os.path.basename(self.path), offset, size, flags)
+        if flags & StreamProtocol.HINT:
+            return offset, size, flags
+
+        if self.pending_request is not None:
+            msg = '%s: got a read request while another is pending' % (os.path.basename(self.path), )
+            self.logger.error(msg)
             raise DownloadError(msg)
 
-        pos = self.client_pos
+        self.pending_request = (offset, size)
+        return offset, size, flags
+
+    def send_range(self, offset, size):
         dcache = self.dcache_entry
-        dcache_buf = dcache.buffer
-        if pos == dcache.size:
-            # return zero len buffer to indicate eof
-            self.logger.debug('%s: end of buffer', os.path.basename(self.path))
-            return ''
-
-        if pos >= len(dcache_buf):
-            self.logger.debug('%s: read would block. pos %d, buf len %d',
-                              os.path.basename(self.path),
-                              pos,
-                              len(dcache_buf))
-            raise StreamReadBlock()
-
-        buf = dcache_buf[pos:pos+size]
-        self.client_pos += len(buf)
-
-        if 0 == len(buf):
-            self.logger.warn('read buffer is len(0)')
-
-        # set the stream readable if the current buffer contain more data
-        if ((len(dcache_buf) - 1) - self.client_pos) > 0:
-            self.is_readable = True
-
-        return buf
+        if not dcache.shared:
+            self.send_segments(dcache.read_range(offset, size))
+            return
+
+        # the proxy reads the data from the shared mapping,
+        # only tell it how much of it is there
+        length = max(min(offset + size, dcache.size) - offset, 0)
+        self.pending_request = None
+        self.client_sock.sendall(StreamProtocol.RESPONSE.pack(length))
+        self.logger.debug('%s: %d bytes ready for client', os.path.basename(self.path), length)
+
+    def send_segments(self, segments):
+        # the segments are sent as they are, without joining them first
+        self.pending_request = None
+        length = sum(len(segment) for segment in segments)
+        self.client_sock.sendall(StreamProtocol.RESPONSE.pack(length))
+        for segment in segments:
+            self.client_sock.sendall(segment)
+        self.logger.debug('%s: sent %d bytes to client', os.path.basename(self.path), length)
+
+    def send_error(self):
+        self.pending_request = None
+        self.client_sock.sendall(StreamProtocol.RESPONSE.pack(StreamProtocol.ERROR))
+        self.logger.warn('%s: sent error to client', os.path.basename(self.path))
@@ -0,0 +1,301 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import itertools
+import json
+import posixpath
+import threading
+import time
+import urllib
+import urlparse
+
+from dropbox_logger import DropboxLogManager
+
+
+class FakeDropboxTree(object):
+    """
+    In-memory files and folders served by FakeDropboxServer, keyed by
+    their lower-cased path like Dropbox does.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = dict()
+        self.children = dict()
+        self.rev = 0
+        # (lower-cased path, path or None when removed) for delta()
+        self.log = list()
+        self.uploads = dict()
+        # (lower-cased path, rev) --> data of every file version
+        self.revisions = dict()
+        self.upload_ids = itertools.count()
+        self.put_folder('/')
+
+    def _add(self, path, entry):
+        lower_path = path.lower()
+        self.rev += 1
+        entry['rev'] = '%x' % self.rev
+        entry['modified'] = time.strftime('%a, %d %b %Y %H:%M:%S +0000', time.gmtime())
+        if lower_path != '/' and lower_path not in self.entries:
+            parent = posixpath.dirname(lower_path)
+            if parent not in self.entries:
+                self._add(posixpath.dirname(path), dict(path=posixpath.dirname(path), is_dir=True))
+            self.children[parent].add(lower_path)
+        if entry['is_dir']:
+            self.children.setdefault(lower_path, set())
+        self.entries[lower_path] = entry
+        self.log.append((lower_path, path))
+
+    def put_file(self, path, data):
+        with self.lock:
+            entry = dict(path=path, is_dir=False, data=data)
+            self._add(path, entry)
+            self.revisions[(path.lower(), entry['rev'])] = data
+
+    def put_folder(self, path):
+        with self.lock:
+            self._add(path, dict(path=path, is_dir=True))
+
+    def remove(self, path):
+        with self.lock:
+            lower_path = path.lower()
+            prefix = lower_path.rstrip('/') + '/'
+            for child in [p for p in self.entries if p.startswith(prefix)]:
+                del self.entries[child]
+                self.children.pop(child, None)
+            entry = self.entries.pop(lower_path)
+            self.children.pop(lower_path, None)
+            self.children[posixpath.dirname(lower_path)].discard(lower_path)
+            self.log.append((lower_path, None))
+            return entry
+
+    def get(self, path):
+        return self.entries.get(path.lower())
+
+    @staticmethod
+    def metadata(entry):
+        # with the fields fuse does not use too, like Dropbox sends them
+        size = 0 if entry['is_dir'] else len(entry['data'])
+        metadata = dict(path=entry['path'], is_dir=entry['is_dir'], rev=entry['rev'],
+                        revision=int(entry['rev'], 16), modified=entry['modified'], bytes=size,
+                        size='%d bytes' % size, root='dropbox', thumb_exists=False, read_only=False,
+                        icon='folder' if entry['is_dir'] else 'page_white')
+        if not entry['is_dir']:
+            metadata['client_mtime'] = entry['modified']
+            metadata['mime_type'] = 'application/octet-stream'
+        return metadata
+
+    def listing(self, entry):
+        with self.lock:
+            children = [self.entries[c] for c in self.children.get(entry['path'].lower(), list())]
+        contents = [FakeDropboxTree.metadata(c) for c in children]
+        listing_hash = hashlib.md5(json.dumps(sorted((c['path'], c['rev']) for c in contents))).hexdigest()
+        return contents, listing_hash
+
+
+class FakeDropboxHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # send the headers and small bodies in one segment, with nagle
+    # and delayed acks every small request would take 40ms
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    # bytes written to the socket between bandwidth checks
+    PIECE_SIZE = 64 * 1024
+
+    def log_message(self, format, *args):
+        pass
+
+    def _throttle(self, size, started):
+        # sleep until size bytes took at least as long as the bandwidth allows
+        bandwidth = self.server.bandwidth
+        if bandwidth:
+            delay = started + float(size) / bandwidth - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    def _reply(self, status, body=''):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        started = time.time()
+        for offset in xrange(0, len(body), FakeDropboxHandler.PIECE_SIZE):
+            self.wfile.write(body[offset:offset + FakeDropboxHandler.PIECE_SIZE])
+            self._throttle(offset + FakeDropboxHandler.PIECE_SIZE, started)
+
+    def _json(self, status, obj):
+        self._reply(status, json.dumps(obj))
+
+    def _not_found(self, path):
+        self._json(404, dict(error='Path %s not found' % path))
+
+    def do_GET(self):
+        self._route()
+
+    def do_POST(self):
+        self._route()
+
+    def do_PUT(self):
+        self._route()
+
+    def _route(self):
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        body = ''
+        if 'Content-Length' in self.headers:
+            started = time.time()
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            self._throttle(len(body), started)
+        if self.command == 'POST' and body:
+            params.update(urlparse.parse_qsl(body))
+
+        path = urllib.unquote(url.path)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        for prefix, call in FakeDropboxServer.ROUTES:
+            if path == prefix or path.startswith(prefix + '/'):
+                self.server.count(call)
+                return getattr(self, '_' + call)(path[len(prefix):] or '/', params, body)
+        self._json(400, dict(error='Unknown call %s' % path))
+
+    def _metadata(self, path, params, body):
+        entry = self.server.tree.get(path)
+        if entry is None:
+            return self._not_found(path)
+        metadata = FakeDropboxTree.metadata(entry)
+        if entry['is_dir']:
+            contents, listing_hash = self.server.tree.listing(entry)
+            if params.get('hash') == listing_hash:
+                return self._reply(304)
+            metadata['hash'] = listing_hash
+            metadata['contents'] = contents
+        self._json(200, metadata)
+
+    def _files(self, path, params, body):
+        entry = self.server.tree.get(path)
+        if entry is None or entry['is_dir']:
+            return self._not_found(path)
+        data = entry['data']
+        if params.get('rev') is not None:
+            data = self.server.tree.revisions.get((path.lower(), params['rev']))
+            if data is None:
+                return self._not_found(path)
+        byte_range = self.headers.get('Range')
+        if byte_range is None:
+            return self._reply(200, data)
+        first, last = byte_range.split('=')[1].split('-')
+        last = int(last) if last else len(data) - 1
+        self._reply(206, data[int(first):last + 1])
+
+    def _chunked_upload(self, path, params, body):
+        tree = self.server.tree
+        with tree.lock:
+            upload_id = params.get('upload_id') or 'upload-%d' % next(tree.upload_ids)
+            data = tree.uploads.get(upload_id, '')
+            status = 200 if int(params.get('offset', 0)) == len(data) else 400
+            if status == 200:
+                data = tree.uploads[upload_id] = data + body
+        self._json(status, dict(upload_id=upload_id, offset=len(data), expires=''))
+
+    def _commit_chunked_upload(self, path, params, body):
+        # the path starts with the root, auto or dropbox
+        path = '/' + posixpath.normpath(path).lstrip('/').split('/', 1)[1]
+        tree = self.server.tree
+        with tree.lock:
+            data = tree.uploads.pop(params.get('upload_id'), None)
+        if data is None:
+            return self._json(400, dict(error='Unknown upload_id'))
+        tree.put_file(path, data)
+        self._json(200, FakeDropboxTree.metadata(tree.get(path)))
+
+    def _create_folder(self, path, params, body):
+        tree = self.server.tree
+        if tree.get(params['path']) is not None:
+            return self._json(403, dict(error='Already exists'))
+        tree.put_folder(params['path'])
+        self._json(200, FakeDropboxTree.metadata(tree.get(params['path'])))
+
+    def _delete(self, path, params, body):
+        if self.server.tree.get(params['path']) is None:
+            return self._not_found(params['path'])
+        self._json(200, FakeDropboxTree.metadata(self.server.tree.remove(params['path'])))
+
+    def _latest_cursor(self, path, params, body):
+        self._json(200, dict(cursor=str(len(self.server.tree.log))))
+
+    def _delta(self, path, params, body):
+        tree = self.server.tree
+        with tree.lock:
+            cursor = int(params.get('cursor') or 0)
+            log = tree.log[cursor:]
+            entries = list()
+            for lower_path, changed in log:
+                entry = tree.entries.get(lower_path)
+                if changed is not None and entry is not None:
+                    entries.append([lower_path, FakeDropboxTree.metadata(entry)])
+                else:
+                    entries.append([lower_path, None])
+            cursor = len(tree.log)
+        self._json(200, dict(entries=entries, cursor=str(cursor), has_more=False, reset=False))
+
+
+class FakeDropboxServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Local stand-in for the Dropbox v1 endpoints used by the mount, for
+    benchmarks. Every request is delayed by latency seconds and bodies
+    are sent and received at bandwidth bytes a second per connection,
+    0 for no limit.
+    """
+    daemon_threads = True
+    # url prefix --> handler, the longest prefixes first
+    ROUTES = (
+        ('/1/metadata/auto', 'metadata'),
+        ('/1/files/auto', 'files'),
+        ('/1/chunked_upload', 'chunked_upload'),
+        ('/1/commit_chunked_upload', 'commit_chunked_upload'),
+        ('/1/fileops/create_folder', 'create_folder'),
+        ('/1/fileops/delete', 'delete'),
+        ('/1/delta/latest_cursor', 'latest_cursor'),
+        ('/1/delta', 'delta'),
+    )
+
+    def __init__(self, latency=0, bandwidth=0, tree=None):
+        self.logger = DropboxLogManager.get_logger(self)
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), FakeDropboxHandler)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.tree = tree if tree is not None else FakeDropboxTree()
+        self.lock = threading.Lock()
+        self.counters = dict()
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+    def count(self, call):
+        with self.lock:
+            self.counters[call] = self.counters.get(call, 0) + 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.logger.info('serving on %s', self.url)
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def attach(self, client):
+        # send the requests of a DropboxClient here instead of to Dropbox
+        session = client.session
+        session.build_url = lambda host, target, params=None: self.url + session.build_path(target, params)
+        return client
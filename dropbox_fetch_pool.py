@@ -0,0 +1,138 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+
+import os
+import errno
+import Queue
+import threading
+from collections import deque
+
+from dropbox_logger import DropboxLogManager
+from dropbox_exceptions import FileNotFoundError, DownloadError
+from dropbox_utils import FileDescriptor
+
+
+class DropboxFetchWorker(threading.Thread):
+    def __init__(self, pool):
+        self.logger = DropboxLogManager.get_logger(self)
+        self.pool = pool
+        super(DropboxFetchWorker, self).__init__()
+        self.daemon = True
+
+    def run(self):
+        queue = self.pool.queue
+        while True:
+            fetcher = queue.get()
+            if fetcher is None:
+                return
+            if fetcher.cancelled:
+                self.pool.close(fetcher)
+                continue
+
+            try:
+                index, data = fetcher.read_next()
+            except (FileNotFoundError, DownloadError) as e:
+                self.pool.close(fetcher)
+                self.pool.complete(fetcher, None, e)
+                continue
+            except Exception as e:
+                self.logger.exception('fetch failed: %s', str(e))
+                self.pool.close(fetcher)
+                self.pool.complete(fetcher, None, DownloadError(str(e)))
+                continue
+
+            # the block has to be queued before the next one is read
+            self.pool.complete(fetcher, index, data)
+            if fetcher.read_done or fetcher.cancelled:
+                self.pool.close(fetcher)
+            else:
+                queue.put(fetcher)
+
+
+class DropboxFetchPool(object):
+    """
+    Worker threads that read the responses of DataCacheFetchers, so a
+    slow download does not hold up the download server loop.
+
+    Fetchers take turns one block at a time. A started fetcher holds a
+    connection with its response open, so readahead fetchers are only
+    started while there are fewer started fetchers than workers, the
+    others wait in line. Demand fetches start right away. The blocks read
+    are handed back through completed(), the pool's fileno() becomes
+    readable once there are some.
+    """
+    def __init__(self, workers=8):
+        self.logger = DropboxLogManager.get_logger(self)
+        self.queue = Queue.Queue()
+        # readahead fetchers not started yet
+        self.waiting = deque()
+        self.started = 0
+        self.max_started = workers
+        self.lock = threading.Lock()
+        # (fetcher, block index, data) or (fetcher, None, exception)
+        self.results = deque()
+        rfd, wfd = os.pipe()
+        self._wakeup = FileDescriptor(rfd)
+        self._wakeup.setblocking(False)
+        self._notify = FileDescriptor(wfd)
+        self._notify.setblocking(False)
+        self.workers = [DropboxFetchWorker(self) for i in xrange(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def fileno(self):
+        return self._wakeup.fileno()
+
+    def submit(self, fetcher):
+        with self.lock:
+            if fetcher.stream is not None and self.started >= self.max_started:
+                self.waiting.append(fetcher)
+                return
+            self.started += 1
+        self.queue.put(fetcher)
+
+    def close(self, fetcher):
+        # the fetcher is done with its connection, the next one in line
+        # may take its place
+        fetcher.close()
+        if fetcher.cancelled:
+            self.complete(fetcher, None, None)
+        with self.lock:
+            self.started -= 1
+            while self.waiting and self.started < self.max_started:
+                fetcher = self.waiting.popleft()
+                if fetcher.cancelled:
+                    self.complete(fetcher, None, None)
+                    continue
+                self.started += 1
+                self.queue.put(fetcher)
+
+    def pending(self):
+        # fetchers waiting for a worker or to be started
+        with self.lock:
+            return self.queue.qsize() + len(self.waiting)
+
+    def complete(self, fetcher, index, result):
+        # a result of None tells a cancelled fetcher was closed
+        self.results.append((fetcher, index, result))
+        try:
+            os.write(self._notify.fileno(), '\0')
+        except OSError as e:
+            # the pipe is full, the loop is woken up anyway
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def completed(self):
+        try:
+            while os.read(self._wakeup.fileno(), 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+        while self.results:
+            yield self.results.popleft()
+
+    def shutdown(self):
+        # workers stuck on a slow response are daemons, don't wait for them
+        for worker in self.workers:
+            self.queue.put(None)
@@ -8,66 +8,145 @@ import sys
 import argparse
 import time
 import stat
+import shutil
+import tempfile
+import threading
+import logging
 
 import dropbox
 from dropbox_exceptions import UploadError, FileNotFoundError, DownloadError
 from dropbox_client import DropboxClient
-from dropbox_cache import CacheManager, MetadataCache, MetadataCacheEntry, DataCache
+from dropbox_connection_pool import DropboxConnectionPool
+from dropbox_cache import CacheManager, MetadataCache, MetadataCacheEntry, DataCache, DataCacheEntry
+from dropbox_block_store import DropboxBlockStore
 from dropbox_download_manager import DropboxDownloadManager
 from dropbox_uploader import DropboxUploader
+from dropbox_writeback import DropboxWriteBack
 from dropbox_logger import DropboxLogManager
+from dropbox_metrics import DropboxMetrics
+from dropbox_sync import DropboxDeltaSync
+from dropbox_snapshot import DropboxMetadataSnapshot
+from dropbox_crawler import DropboxCrawler
 
 
 class DropboxFuse(fuse.Operations):
-    def __init__(self, dropbox_client):
+    # file handles from here on are write handles, lower ones are downloads
+    WRITE_FH = 1 << 32
+    # the only operations allowed on the stats file
+    STATS_OPS = ('getattr', 'access', 'open', 'read', 'flush', 'release')
+    # seconds a file truncated while not open waits for an open before it is committed
+    TRUNCATE_DELAY = 1
+
+    def __init__(self, dropbox_client, download_manager=None, upload_chunk_size=None, writeback=None,
+                 staging_dir=None, stats_file='.dropboxfuse-stats'):
         self.logger = DropboxLogManager.get_logger(self)
+        self.op_logger = DropboxLogManager.get_op_logger(self)
         # dropbox api client
         self.client = dropbox_client
+        self.upload_chunk_size = upload_chunk_size
+        # uploads and commits run in the background when set
+        self.writeback = writeback
+        # where files written at random offsets are kept until they are closed
+        self.staging_dir = staging_dir
+        self.next_write_fh = DropboxFuse.WRITE_FH
+        # read-only file in the mount root with the metrics, not listed
+        # by readdir. (render time, text) of the last rendering and the
+        # text each open handle reads from
+        self.stats_path = '/' + stats_file if stats_file else None
+        self.stats_text = None
+        self.stats_files = dict()
+        # read-only handles of files open for writing elsewhere --> the
+        # uploader they read from, or the download fd once it committed
+        self.upload_readers = dict()
         # cache init
         self.cache = CacheManager.get_cache('MetadataCache')
         self.cache.get_entry('/')
         # downloader
-        self.download_manager = DropboxDownloadManager(dropbox_client)
+        if download_manager is None:
+            download_manager = DropboxDownloadManager(dropbox_client)
+        self.download_manager = download_manager
+        # files truncated while not open --> (uploader, timer), an open
+        # for writing that follows takes the uploader over
+        self.truncated = dict()
+        # guards attaching uploaders to cache entries
+        self.lock = threading.Lock()
+
+    def _new_uploader(self, path, overwrite):
+        return DropboxUploader(path, self.client,
+                               overwrite=overwrite,
+                               chunk_size=self.upload_chunk_size,
+                               writeback=self.writeback,
+                               staging_dir=self.staging_dir)
+
+    def _write_fh(self):
+        fh = self.next_write_fh
+        self.next_write_fh += 1
+        return fh
+
+    def __call__(self, op, *args):
+        if self.stats_path is not None and args and args[0] == self.stats_path and op not in DropboxFuse.STATS_OPS:
+            raise fuse.FuseOSError(errno.EACCES)
+
+        with DropboxMetrics.timer('dropbox_fuse_op_seconds', op=op):
+            try:
+                return super(DropboxFuse, self).__call__(op, *args)
+            except fuse.FuseOSError as e:
+                DropboxMetrics.inc('dropbox_fuse_op_errors_total', op=op, errno=errno.errorcode.get(e.errno, e.errno))
+                raise
+
+    def metrics(self):
+        # the metrics of both processes in the Prometheus text format
+        collected = dict(fuse=DropboxMetrics.collect())
+        try:
+            collected.update(self.download_manager.stats())
+        except DownloadError as e:
+            self.logger.error('failed to get download server stats: %s', str(e))
+        return DropboxMetrics.render(collected)
+
+    def _stats_text(self):
+        # getattr renders the file to tell its size, the
+        # open that follows right after reads the same text
+        now = time.time()
+        stats_text = self.stats_text
+        if stats_text is None or now - stats_text[0] > 1:
+            stats_text = self.stats_text = (now, self.metrics())
+        return stats_text[1]
+
+    def _stats_getattr(self):
+        now = time.time()
+        uid, gid, pid = fuse.fuse_get_context()
+        return dict(st_size=len(self._stats_text()), st_ctime=now, st_mtime=now, st_atime=now,
+                    st_uid=uid, st_gid=gid, st_mode=stat.S_IFREG | 0444, st_nlink=1)
+
+    def _stats_open(self, flags):
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            raise fuse.FuseOSError(errno.EACCES)
+        # from the write range, read() and release() look for it first
+        with self.lock:
+            fh = self._write_fh()
+        self.stats_files[fh] = self._stats_text()
+        return fh
 
     def access(self, path, mode):
-        self.logger.info('access %s', path)
+        self.op_logger.debug('access %s', path)
+        if path == self.stats_path:
+            return 0
         try:
             cache_entry = self.cache.get_entry(path)
         except FileNotFoundError:
             raise fuse.FuseOSError(errno.ENOENT)
 
     def getattr(self, path, fh=None):
-        self.logger.info('getattr %s', path)
+        self.op_logger.debug('getattr %s', path)
+        if path == self.stats_path:
+            return self._stats_getattr()
         try:
             cache_entry = self.cache.get_entry(path)
         except FileNotFoundError:
             raise fuse.FuseOSError(errno.ENOENT)
 
-        now = time.time()
-        if 'modified' in cache_entry.metadata:
-            modified = cache_entry.metadata['modified'].replace('+0000', '').strip()
-            modified = time.strptime(modified, '%a, %d %b %Y %H:%M:%S')
-            modified = time.mktime(modified)
-        else:
-            modified = now
-
         uid, gid, pid = fuse.fuse_get_context()
-        ret = dict(
-            st_size=int(cache_entry.metadata['bytes']),
-            st_ctime=now,
-            st_mtime=modified,
-            st_atime=now,
-            st_uid=uid,
-            st_gid=gid
-        )
-        if cache_entry.metadata['is_dir'] is True:
-            ret['st_mode'] = stat.S_IFDIR | 0755
-            ret['st_nlink'] = 3
-        else:
-            ret['st_mode'] = stat.S_IFREG | 0644
-            ret['st_nlink'] = 1
-
-        return ret
+        return dict(cache_entry.stat, st_uid=uid, st_gid=gid)
 
     def mkdir(self, path, fh=None):
         self.logger.info('mkdir %s', path)
@@ -90,54 +169,126 @@ class DropboxFuse(fuse.Operations):
         self.logger.info('mknod %s', path)
         raise fuse.FuseOSError(errno.EACCES)
 
+    def _wait_commit(self, path, cache_entry):
+        # returns the entry of path once a commit in flight landed
+        while cache_entry is not None and cache_entry.uploader is not None and cache_entry.uploader.committing:
+            self.logger.info('%s: waiting for the commit', path)
+            uploader = cache_entry.uploader
+            uploader.wait_finished()
+            cache_entry = self.cache.get_entry(path, create=False)
+            if cache_entry is not None and cache_entry.uploader is uploader:
+                # the commit ended without replacing its placeholder
+                self.logger.error('%s: commit finished without updating the cache', path)
+                break
+        return cache_entry
+
     def create(self, path, mode, fh=None):
         self.logger.info('create %s', path)
+        self._wait_commit(path, self.cache.get_entry(path, create=False))
+        with self.lock:
+            return self._create(path)
+
+    def _create(self, path):
         cache_entry = self.cache.get_entry(path, create=False)
         should_overwrite = True if cache_entry is not None else False
         if cache_entry is None:
             self.logger.info('creating MetadataCacheEntry')
             cache_entry = MetadataCacheEntry(path, self.client)
 
+        if cache_entry.uploader is not None and self._adopt_truncated(path, cache_entry.uploader):
+            # the truncate lands with what this handle writes
+            try:
+                cache_entry.uploader.truncate(0)
+            except UploadError as e:
+                self.logger.error('upload error: %s', str(e))
+                raise fuse.FuseOSError(errno.EIO)
+            cache_entry.update(size=0)
+            self.cache.set_entry(path, cache_entry)
+            return self._write_fh()
+
         if cache_entry.uploader is not None:
             self.logger.info('uploader already exists, setting fuse as EBUSY')
             raise fuse.FuseOSError(errno.EBUSY)
 
-        cache_entry.uploader = DropboxUploader(path, self.client, overwrite=should_overwrite)
+        cache_entry.uploader = self._new_uploader(path, should_overwrite)
 
         #fakeing a cache entry metadata, will be overwritten later
         #by the real metadata from dropbox
-        cache_entry.metadata['bytes'] = '0'
-        cache_entry.metadata['is_dir'] = False
-        cache_entry.metadata['path'] = path
+        cache_entry.update(size=0, is_dir=False)
         self.cache.set_entry(path, cache_entry)
         self.cache.set_parent_dirty(cache_entry)
-        return 0
+        return self._write_fh()
+
+    def _open_existing(self, path):
+        try:
+            cache_entry = self.cache.get_entry(path)
+        except FileNotFoundError:
+            raise fuse.FuseOSError(errno.ENOENT)
+
+        if cache_entry.uploader is not None and self._adopt_truncated(path, cache_entry.uploader):
+            return self._write_fh()
+
+        cache_entry.refresh()
+        if cache_entry.is_dir is True:
+            raise fuse.FuseOSError(errno.EISDIR)
+
+        if cache_entry.uploader is not None:
+            self.logger.info('uploader already exists, setting fuse as EBUSY')
+            raise fuse.FuseOSError(errno.EBUSY)
+
+        # the remote content is fetched on the first write
+        # or read, unless the file is truncated before
+        cache_entry.uploader = self._new_uploader(path, True)
+        cache_entry.uploader.open_existing(cache_entry.size, cache_entry.rev)
+        self.cache.set_entry(path, cache_entry)
+        return self._write_fh()
+
+    def _adopt_truncated(self, path, uploader):
+        # self.lock is held, True if uploader is of a truncate not committed yet
+        pending = self.truncated.get(path)
+        if pending is None or pending[0] is not uploader:
+            return False
+        del self.truncated[path]
+        pending[1].cancel()
+        return True
 
     def open(self, path, flags):
-        flags = 32768 - flags
+        accmode = flags & (os.O_RDONLY | os.O_WRONLY | os.O_RDWR)
         self.logger.info('open %s %d', path, flags)
+        if path == self.stats_path:
+            return self._stats_open(flags)
 
-        if flags == os.O_RDWR:
-            self.logger.info('invalid flags: O_RDWR')
-            raise fuse.FuseOSError(errno.EINVAL)
-
-        if flags == os.O_WRONLY:
-            # if it O_WRONLY, let self.create do its thing
-            self.logger.info('valid flags: O_WRONLY')
+        if accmode == os.O_WRONLY and flags & os.O_TRUNC:
+            # a new upload, let self.create do its thing
+            self.logger.info('valid flags: O_WRONLY | O_TRUNC')
             return self.create(path, 0444)
-        elif flags != os.O_RDONLY:
-            # if there is no O_WRONLY / O_RD_ONLY
-            self.logger.error('invalid flags: not O_RDONLY or O_WRONLY')
+        elif accmode in (os.O_WRONLY, os.O_RDWR):
+            self.logger.info('valid flags: O_WRONLY / O_RDWR')
+            self._wait_commit(path, self.cache.get_entry(path, create=False))
+            with self.lock:
+                return self._open_existing(path)
+        elif accmode != os.O_RDONLY:
+            self.logger.error('invalid flags: not O_RDONLY, O_WRONLY or O_RDWR')
             raise fuse.FuseOSError(errno.EINVAL)
 
         # in case of O_RDONLY
         self.logger.info('valid flags: O_RDONLY')
         try:
-            cache_entry = self.cache.get_entry(path, self.client)
+            cache_entry = self._wait_commit(path, self.cache.get_entry(path, self.client))
+            if cache_entry is None:
+                # the commit failed, the file is what dropbox has
+                cache_entry = self.cache.get_entry(path)
         except FileNotFoundError as e:
             self.logger.error('file not found error: %s', path)
             raise fuse.FuseOSError(errno.ENOENT)
 
+        if cache_entry.uploader is not None:
+            # open for writing elsewhere, read what was written so far
+            with self.lock:
+                fh = self._write_fh()
+                self.upload_readers[fh] = cache_entry.uploader
+            return fh
+
         try:
             fd = self.download_manager.open_file(path)
             self.cache.set_entry(path, cache_entry)
@@ -148,9 +299,10 @@ class DropboxFuse(fuse.Operations):
 
     def write(self, path, buf, offset, fh=None):
         fd = int(fh)
-        self.logger.info('write %s size %d offset %d fd %d',
-                         os.path.basename(path),
-                         len(buf), offset, fd)
+        if self.op_logger.isEnabledFor(logging.DEBUG):
+            self.op_logger.debug('write %s size %d offset %d fd %d',
+                                 os.path.basename(path),
+                                 len(buf), offset, fd)
 
         cache_entry = self.cache.get_entry(path, create=False)
         if cache_entry is None:
@@ -161,21 +313,44 @@ class DropboxFuse(fuse.Operations):
             self.logger.error('uploader not found')
             raise fuse.FuseOSError(errno.EBADR)
 
-        cache_entry.uploader.upload_chunk(buf, offset)
+        try:
+            cache_entry.uploader.write(buf, offset)
+        except UploadError as e:
+            self.logger.error('upload error: %s', str(e))
+            raise fuse.FuseOSError(errno.EIO)
+        # the placeholder tells the local size until the commit lands
+        cache_entry.update(size=cache_entry.uploader.size)
         self.cache.set_entry(path, cache_entry)
         return len(buf)
 
     def read(self, path, size, offset, fh):
         fd = int(fh)
-        self.logger.info('read %s size %d offset %d fd %d',
-                         os.path.basename(path),
-                         size, offset, fd)
+        if self.op_logger.isEnabledFor(logging.DEBUG):
+            self.op_logger.debug('read %s size %d offset %d fd %d',
+                                 os.path.basename(path),
+                                 size, offset, fd)
+
+        if fd in self.stats_files:
+            return self.stats_files[fd][offset:offset + size]
+
+        if fd in self.upload_readers:
+            return self._read_upload(path, size, offset, fd)
 
         cache_entry = self.cache.get_entry(path, create=False)
         if cache_entry is None:
             self.logger.error('cache inconsistency')
             raise fuse.FuseOSError(errno.ENOENT)
 
+        if fd >= DropboxFuse.WRITE_FH:
+            if cache_entry.uploader is None:
+                self.logger.error('uploader not found')
+                raise fuse.FuseOSError(errno.EBADF)
+            try:
+                return cache_entry.uploader.read(size, offset)
+            except UploadError as e:
+                self.logger.error('upload error: %s', str(e))
+                raise fuse.FuseOSError(errno.EIO)
+
         proxy = self.download_manager.download_by_fd(fd)
         if proxy is None:
             self.logger.error('downloader proxy not found')
@@ -183,14 +358,48 @@ class DropboxFuse(fuse.Operations):
 
         try:
             buf = proxy.read(size, offset=offset)
-            self.logger.debug('got %d bytes from proxy', len(buf))
+            self.op_logger.debug('got %d bytes from proxy', len(buf))
         except DownloadError as e:
             raise fuse.FuseOSError(errno.EIO)
         return buf
 
+    def _read_upload(self, path, size, offset, fd):
+        reader = self.upload_readers[fd]
+        if isinstance(reader, DropboxUploader):
+            try:
+                buf = reader.read(size, offset)
+            except UploadError as e:
+                self.logger.error('upload error: %s', str(e))
+                raise fuse.FuseOSError(errno.EIO)
+            if buf is not None:
+                return buf
+
+            # the writer closed the file, read what it committed
+            reader.wait_finished()
+            try:
+                reader = self.download_manager.open_file(path)
+            except Exception as e:
+                self.logger.error('%s: failed to open the committed file: %s', path, str(e))
+                raise fuse.FuseOSError(errno.EIO)
+            self.upload_readers[fd] = reader
+
+        try:
+            return self.download_manager.download_by_fd(reader).read(size, offset=offset)
+        except DownloadError as e:
+            raise fuse.FuseOSError(errno.EIO)
+
     def release(self, path, fh=None):
         fd = int(fh)
         self.logger.info('release %s fd %d', path, fd)
+        if fd in self.stats_files:
+            del self.stats_files[fd]
+            return 0
+
+        if fd in self.upload_readers:
+            reader = self.upload_readers.pop(fd)
+            if not isinstance(reader, DropboxUploader):
+                self.download_manager.close_file(reader)
+            return 0
 
         try:
             cache_entry = self.cache.get_entry(path)
@@ -198,17 +407,120 @@ class DropboxFuse(fuse.Operations):
             self.logger.error('file not found error: %s', path)
             raise fuse.FuseOSError(errno.ENOENT)
 
-        if cache_entry.uploader is not None:
+        if fd >= DropboxFuse.WRITE_FH:
+            self._finish_upload(path, cache_entry)
+            return 0
+
+        self.download_manager.close_file(fd)
+
+    def _finish_upload(self, path, cache_entry):
+        uploader = cache_entry.uploader
+        if uploader is None:
+            return
+
+        if not uploader.dirty:
+            uploader.discard()
+            cache_entry.uploader = None
+            self.cache.set_entry(path, cache_entry)
+        elif self.writeback is not None:
+            # the placeholder entry stays until the commit lands
+            uploader.commit_later(self._committed)
+        else:
+            cache_entry, error = None, None
             try:
-                cache_entry = cache_entry.uploader.commit()
-            except UploadError as e:
-                self.logger.error('upload error error: %s', str(e))
+                try:
+                    cache_entry = uploader.commit()
+                except UploadError as e:
+                    error = e
+                # replace the old fake entry with the new cache entry
+                self._committed(uploader, cache_entry, error)
+            finally:
+                uploader.finish()
+            if error is not None:
                 raise fuse.FuseOSError(errno.EIO)
-            # replace the old fake entry with the new cache entry
-            self.cache.set_entry(path, cache_entry)
 
-        fd = int(fh)
-        self.download_manager.close_file(fd)
+    def _committed(self, uploader, cache_entry, error):
+        path = uploader.path
+        if error is not None:
+            self.logger.error('%s: upload failed: %s', path, str(error))
+            # drop the placeholder, the next lookup asks dropbox
+            placeholder = self.cache.get_entry(path, create=False)
+            if placeholder is not None and placeholder.uploader is uploader:
+                self.cache.remove_entry(path)
+                self.cache.set_parent_dirty(placeholder)
+            return
+
+        self.logger.info('%s: upload committed', path)
+        self.cache.set_entry(path, cache_entry)
+
+    def fsync(self, path, datasync, fh):
+        self.logger.info('fsync %s', path)
+        cache_entry = self.cache.get_entry(path, create=False)
+        if cache_entry is None or cache_entry.uploader is None:
+            return 0
+
+        try:
+            cache_entry.uploader.sync()
+        except UploadError as e:
+            self.logger.error('upload error: %s', str(e))
+            raise fuse.FuseOSError(errno.EIO)
+        return 0
+
+    def truncate(self, path, length, fh=None):
+        self.logger.info('truncate %s %d', path, length)
+        # a closed file is truncated once its commit landed
+        self._wait_commit(path, self.cache.get_entry(path, create=False))
+        with self.lock:
+            cache_entry = self.cache.get_entry(path, create=False)
+            opened = cache_entry is not None and cache_entry.uploader is not None
+            if not opened:
+                # not open for writing, the truncated file is uploaded
+                # unless an open for writing follows, see _commit_truncated
+                self._open_existing(path)
+                cache_entry = self.cache.get_entry(path)
+
+        try:
+            cache_entry.uploader.truncate(length)
+        except UploadError as e:
+            self.logger.error('upload error: %s', str(e))
+            raise fuse.FuseOSError(errno.EIO)
+        cache_entry.update(size=cache_entry.uploader.size)
+        self.cache.set_entry(path, cache_entry)
+
+        if not opened:
+            uploader = cache_entry.uploader
+            timer = threading.Timer(DropboxFuse.TRUNCATE_DELAY, self._commit_truncated, (path, uploader))
+            timer.daemon = True
+            with self.lock:
+                self.truncated[path] = (uploader, timer)
+            timer.start()
+        return 0
+
+    def _commit_truncated(self, path, uploader):
+        # no open took the truncated file over
+        with self.lock:
+            pending = self.truncated.get(path)
+            if pending is None or pending[0] is not uploader:
+                return
+            del self.truncated[path]
+            cache_entry = self.cache.get_entry(path, create=False)
+        if cache_entry is None or cache_entry.uploader is not uploader:
+            # unlinked in the meantime
+            uploader.discard()
+            return
+        try:
+            self._finish_upload(path, cache_entry)
+        except fuse.FuseOSError:
+            # logged by _committed, the placeholder is gone
+            pass
+
+    def destroy(self, path):
+        # truncated files are committed before unmount
+        with self.lock:
+            pending = self.truncated.items()
+        for path, (uploader, timer) in pending:
+            timer.cancel()
+            self._commit_truncated(path, uploader)
 
     def unlink(self, path):
         self.logger.info('unlink %s', path)
@@ -239,27 +551,23 @@ class DropboxFuse(fuse.Operations):
         return 0
 
     def readdir(self, path, fh):
-        self.logger.info('readdir %s', path)
+        self.op_logger.debug('readdir %s', path)
 
         try:
-            cache_entry = self.cache.get_entry(path)
+            # fills the contents and caches the children, so the
+            # getattr calls that follow don't go to dropbox
+            cache_entry = self.cache.list_directory(path)
         except FileNotFoundError as e:
             self.logger.error('file not found error: %s', path)
             raise fuse.FuseOSError(errno.ENOENT)
 
-        if cache_entry.metadata['is_dir'] is False:
+        if cache_entry.is_dir is False:
             self.logger.error('%s not a directory', path)
             raise fuse.FuseOSError(errno.ENOTDIR)
 
         files = ['.', '..']
-        if not 'contents' in cache_entry.metadata:
-            # cache entry might not be full, fetching info
-            self.logger.info('setting metadata cache dirty: %s', cache_entry.path)
-            cache_entry.dirty = True
-
-        for content in cache_entry.metadata['contents']:
-            basename = os.path.basename(content['path'])
-            files.append(basename)
+        for child in cache_entry.children.values():
+            files.append(os.path.basename(child.path))
 
         return files
 
@@ -272,26 +580,156 @@ def main():
     parser.add_argument('-k', '--app-key', type=str, default=None, required=False)
     parser.add_argument('-s', '--app-secret', type=str, default=None, required=False)
     parser.add_argument('-a', '--access-token', type=str, default=None, required=False)
+    parser.add_argument('--cache-dir', type=str, default=None, required=False)
+    parser.add_argument('--log-level', type=str, choices=('debug', 'info', 'warning', 'error'), default='info',
+                        required=False)
+    parser.add_argument('--log-batch', type=int, default=64, required=False,
+                        help='log records shipped to the log process at once')
+    parser.add_argument('--log-sample-rate', type=int, default=50, required=False,
+                        help='per operation debug messages logged a second, 0 for all')
+    parser.add_argument('--cache-size', type=int, default=1024, required=False,
+                        help='block cache size in MB')
+    parser.add_argument('--memory-cache-size', type=int, default=256, required=False,
+                        help='in-memory data cache size in MB')
+    parser.add_argument('--transport', type=str, choices=('socket', 'shm'), default='socket', required=False,
+                        help='how file data is passed from the download server')
+    parser.add_argument('--negative-ttl', type=int, default=30, required=False,
+                        help='seconds to remember paths that were not found')
+    parser.add_argument('--snapshot', type=str, default=None, required=False,
+                        help='metadata snapshot file, defaults to the config path with a .snapshot suffix')
+    parser.add_argument('--snapshot-interval', type=int, default=300, required=False,
+                        help='seconds between metadata snapshots, 0 to save on unmount only')
+    parser.add_argument('--sync-interval', type=int, default=60, required=False,
+                        help='seconds between remote change checks, 0 to disable')
+    parser.add_argument('-t', '--threads', action='store_true', default=False, required=False,
+                        help='serve fuse requests from multiple threads')
+    parser.add_argument('--readahead', type=int, default=32, required=False,
+                        help='max readahead window per open file in MB, 0 to disable')
+    parser.add_argument('--readahead-total', type=int, default=256, required=False,
+                        help='max readahead in flight for all open files in MB')
+    parser.add_argument('--fetch-workers', type=int, default=8, required=False,
+                        help='threads reading file data from dropbox per download server')
+    parser.add_argument('--download-servers', type=int, default=1, required=False,
+                        help='processes serving file data, files are spread over them by path')
+    parser.add_argument('--upload-chunk-size', type=int, default=8, required=False,
+                        help='writes are buffered and uploaded in chunks of this size in MB')
+    parser.add_argument('--write-back', type=int, default=0, required=False,
+                        help='upload and commit in the background with this many workers, 0 to disable')
+    parser.add_argument('--write-back-queue', type=int, default=64, required=False,
+                        help='max pending write-back jobs before writes block')
+    parser.add_argument('--pool-size', type=int, default=8, required=False,
+                        help='idle connections kept open per host')
+    parser.add_argument('--pool-max-per-host', type=int, default=16, required=False,
+                        help='max open connections per host, more requests wait')
+    parser.add_argument('--pool-idle-timeout', type=int, default=60, required=False,
+                        help='seconds an idle connection is reused for')
+    parser.add_argument('--crawl', type=str, action='append', default=None, required=False,
+                        help='directory to list in the background after mounting, can be repeated')
+    parser.add_argument('--crawl-workers', type=int, default=8, required=False,
+                        help='directories listed in parallel by the crawler')
+    parser.add_argument('--crawl-depth', type=int, default=-1, required=False,
+                        help='levels below a crawled directory to list, -1 for no limit')
+    parser.add_argument('--crawl-include', type=str, action='append', default=None, required=False,
+                        help='only crawl directories matching this glob, can be repeated')
+    parser.add_argument('--crawl-exclude', type=str, action='append', default=None, required=False,
+                        help='skip directories matching this glob, can be repeated')
+    parser.add_argument('--stats-file', type=str, default='.dropboxfuse-stats', required=False,
+                        help='name of the metrics file in the mount root, empty to disable')
+    parser.add_argument('--staging-dir', type=str, default=None, required=False,
+                        help='where files written at random offsets are staged, defaults to the temp directory')
 
     options = parser.parse_args()
-    log_manager = DropboxLogManager()
-    dropbox_client = DropboxClient(options.config, options.app_key, options.app_secret, options.access_token)
-    CacheManager.set_cache('MetadataCache', MetadataCache(dropbox_client))
-    CacheManager.set_cache('DataCache', DataCache(dropbox_client))
-    dropbox_fuse = DropboxFuse(dropbox_client)
+    log_manager = DropboxLogManager(level=getattr(logging, options.log_level.upper()),
+                                    batch_size=options.log_batch,
+                                    sample_rate=options.log_sample_rate)
+    connection_pool = DropboxConnectionPool(size=options.pool_size,
+                                            max_per_host=options.pool_max_per_host,
+                                            idle_timeout=options.pool_idle_timeout)
+    dropbox_client = DropboxClient(options.config, options.app_key, options.app_secret, options.access_token,
+                                   rest_client=connection_pool)
+    # the cache budgets are split between the download servers,
+    # each one gets a block store of its own
+    servers = options.download_servers
+    block_store = None
+    block_stores = None
+    if options.cache_dir is not None and servers == 1:
+        block_store = DropboxBlockStore(options.cache_dir,
+                                        options.cache_size * 1024 * 1024,
+                                        DataCacheEntry.BLOCK_SIZE)
+    elif options.cache_dir is not None:
+        block_stores = [DropboxBlockStore(os.path.join(options.cache_dir, 'shard-%d' % i),
+                                          options.cache_size * 1024 * 1024 // servers,
+                                          DataCacheEntry.BLOCK_SIZE) for i in xrange(servers)]
+    shared_dir = None
+    if options.transport == 'shm':
+        shm_root = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        shared_dir = tempfile.mkdtemp(prefix='dropboxfuse-', dir=shm_root)
+    CacheManager.set_cache('MetadataCache', MetadataCache(dropbox_client, negative_ttl=options.negative_ttl))
+    CacheManager.set_cache('DataCache', DataCache(dropbox_client,
+                                                  store=block_store,
+                                                  max_bytes=options.memory_cache_size * 1024 * 1024 // servers,
+                                                  shared_dir=shared_dir))
+    download_manager = DropboxDownloadManager(dropbox_client,
+                                              servers=servers,
+                                              stores=block_stores,
+                                              readahead=options.readahead * 1024 * 1024,
+                                              readahead_total=options.readahead_total * 1024 * 1024 // servers,
+                                              fetch_workers=options.fetch_workers)
+    writeback = None
+    if options.write_back > 0:
+        writeback = DropboxWriteBack(workers=options.write_back, queue_size=options.write_back_queue)
+    dropbox_fuse = DropboxFuse(dropbox_client, download_manager,
+                               upload_chunk_size=options.upload_chunk_size * 1024 * 1024,
+                               writeback=writeback,
+                               staging_dir=options.staging_dir,
+                               stats_file=options.stats_file)
+    snapshot_path = options.snapshot if options.snapshot is not None else options.config + '.snapshot'
+    snapshot = DropboxMetadataSnapshot(CacheManager.get_cache('MetadataCache'),
+                                       snapshot_path,
+                                       interval=options.snapshot_interval)
+    snapshot.start()
+    delta_sync = None
+    if options.sync_interval > 0:
+        delta_sync = DropboxDeltaSync(dropbox_client,
+                                      CacheManager.get_cache('MetadataCache'),
+                                      interval=options.sync_interval)
+        delta_sync.start()
+    crawler = None
+    if options.crawl:
+        crawler = DropboxCrawler(CacheManager.get_cache('MetadataCache'),
+                                 workers=options.crawl_workers,
+                                 max_depth=options.crawl_depth if options.crawl_depth >= 0 else None,
+                                 include=options.crawl_include,
+                                 exclude=options.crawl_exclude)
+        crawler.start(options.crawl)
     try:
         dbfuse = fuse.FUSE(dropbox_fuse,
                            options.mount_point,
                            foreground=True,
-                           nothreads=True,
+                           nothreads=not options.threads,
                            allow_other=True)
     except Exception as e:
         print str(e)
         raise
     finally:
+        if crawler is not None:
+            crawler.stop()
+        if writeback is not None:
+            writeback.shutdown()
+        if delta_sync is not None:
+            delta_sync.stop()
+        snapshot.stop()
+        try:
+            snapshot.save()
+        except Exception as e:
+            # the rest still has to be cleaned up, and a fuse error is more interesting
+            snapshot.logger.error('failed to save metadata snapshot: %s', str(e))
+        connection_pool.logger.info('connection pool: %s', connection_pool.stats())
         del dropbox_fuse
         del dropbox_client
         del log_manager
+        if shared_dir is not None:
+            shutil.rmtree(shared_dir, ignore_errors=True)
     return 0
 
 if __name__ == '__main__':
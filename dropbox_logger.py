@@ -2,7 +2,10 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import os
 import sys
+import time
+import threading
 import traceback
 import multiprocessing
 
@@ -10,48 +13,128 @@ import multiprocessing
 class QueueHandler(logging.Handler):
     """
     This is a logging handler which sends events to a multiprocessing queue.
+
+    Records are shipped in batches of up to batch_size, a batch goes out
+    once it is full, after flush_interval seconds or right away for
+    warnings and errors.
     """
 
-    def __init__(self, queue):
+    def __init__(self, queue, batch_size=64, flush_interval=0.5):
         """
         Initialise an instance, using the passed queue.
         """
         self.queue = queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.batch = list()
+        self._pid = None
         super(QueueHandler, self).__init__()
 
+    def prepare(self, record):
+        # merge the arguments into the message, so the record pickles
+        # cheaply and does not depend on the arguments being picklable
+        ei = record.exc_info
+        if ei:
+            # just to get traceback text into record.exc_text
+            dummy = self.format(record)
+            # not needed any more
+            record.exc_info = None
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def _start_flusher(self):
+        # the flusher thread does not survive a fork, every process
+        # starts its own and drops the batch it inherited
+        self._pid = os.getpid()
+        self.batch = list()
+        flusher = threading.Thread(target=self._flush_periodically)
+        flusher.daemon = True
+        flusher.start()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
     def emit(self, record):
         """
         Emit a record.
 
-        Writes the LogRecord to the queue.
+        Adds the LogRecord to the batch going to the queue.
         """
         try:
-            ei = record.exc_info
-            if ei:
-                # just to get traceback text into record.exc_text
-                dummy = self.format(record)
-                # not needed any more
-                record.exc_info = None
-            self.queue.put_nowait(record)
+            if self._pid != os.getpid():
+                self._start_flusher()
+            self.batch.append(self.prepare(record))
+            if len(self.batch) >= self.batch_size or record.levelno >= logging.WARNING:
+                self.flush()
         except (KeyboardInterrupt, SystemExit):
             raise
         except:
             print record, type(record), dir(record)
             self.handleError(record)
 
+    def flush(self):
+        self.acquire()
+        try:
+            batch, self.batch = self.batch, list()
+        finally:
+            self.release()
+        if batch:
+            self.queue.put_nowait(batch)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets at most rate records a second through, the first record after
+    a dropped streak tells how many were dropped.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.window = 0
+        self.count = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+        super(RateLimitFilter, self).__init__()
+
+    def filter(self, record):
+        if self.rate <= 0:
+            return True
+
+        window = int(time.time())
+        with self.lock:
+            if window != self.window:
+                self.window = window
+                self.count = 0
+            self.count += 1
+            if self.count > self.rate:
+                self.dropped += 1
+                return False
+            dropped, self.dropped = self.dropped, 0
+
+        if dropped:
+            record.msg = '%s (%d similar messages dropped)' % (record.getMessage(), dropped)
+            record.args = None
+        return True
+
 
 class DropboxLogServer(multiprocessing.Process):
-    def __init__(self, queue):
+    def __init__(self, queue, level=logging.INFO):
         self.queue = queue
+        self.level = level
         self.logger = None
         super(DropboxLogServer, self).__init__()
 
     def run(self):
         root = logging.getLogger()
-        root.setLevel(logging.DEBUG)
-        # create console handler and set level to debug
+        # drop the handler shipping records here, inherited by the fork
+        root.handlers = list()
+        root.setLevel(self.level)
+        # create console handler
         handler = logging.StreamHandler()
-        handler.setLevel(logging.DEBUG)
+        handler.setLevel(self.level)
         # create formatter
         formatter = logging.Formatter('%(asctime)s %(name)-24s %(levelname)-10s %(message)s')
         handler.setFormatter(formatter)
@@ -64,9 +147,10 @@ class DropboxLogServer(multiprocessing.Process):
                 if record is None:
                     break
 
-                logger = logging.getLogger(record.name)
-                # No level or filter logic applied - just do it!
-                logger.handle(record)
+                for item in record:
+                    logger = logging.getLogger(item.name)
+                    # No level or filter logic applied - just do it!
+                    logger.handle(item)
             except (KeyboardInterrupt, SystemExit):
                 raise
             except:
@@ -75,15 +159,21 @@ class DropboxLogServer(multiprocessing.Process):
 
 
 class DropboxLogManager(object):
-    def __init__(self):
+    # per-op messages a second let through by each ops logger, 0 for all
+    sample_rate = 50
+
+    def __init__(self, level=logging.INFO, batch_size=64, sample_rate=50):
         self.queue = multiprocessing.Queue()
         # create the log server
-        self.process = DropboxLogServer(self.queue)
+        self.process = DropboxLogServer(self.queue, level)
         self.start()
         # set root logger handlers
         root = logging.getLogger()
-        root.addHandler(QueueHandler(self.queue))
-        root.setLevel(logging.DEBUG)
+        self.handler = QueueHandler(self.queue, batch_size=batch_size)
+        root.addHandler(self.handler)
+        # records below the level are dropped before they are created
+        root.setLevel(level)
+        DropboxLogManager.sample_rate = sample_rate
 
     def __del__(self):
         self.stop()
@@ -92,6 +182,7 @@ class DropboxLogManager(object):
         self.process.start()
 
     def stop(self):
+        self.handler.flush()
         self.queue.put(None)
         self.process.join(timeout=60)
 
@@ -99,4 +190,20 @@ class DropboxLogManager(object):
     def get_logger(module):
         if not isinstance(module, (str, unicode)):
             module = module.__class__.__name__
-        return logging.getLogger(module)
\ No newline at end of file
+        return logging.getLogger(module)
+
+    @staticmethod
+    def get_op_logger(module):
+        # logger for messages logged on every fuse operation or cache
+        # lookup, rate limited so busy mounts don't drown in them
+        logger = DropboxLogManager.get_logger(module)
+        logger = logger.getChild('ops')
+        if not logger.filters:
+            logger.addFilter(RateLimitFilter(DropboxLogManager.sample_rate))
+        return logger
+
+    @staticmethod
+    def flush():
+        # ships the pending records of this process, before it exits
+        for handler in logging.getLogger().handlers:
+            handler.flush()
\ No newline at end of file
@@ -0,0 +1,165 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+
+import bisect
+import threading
+import time
+
+
+class Histogram(object):
+    # upper bounds in seconds, the +Inf bucket is implied
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class DropboxMetrics(object):
+    """
+    Counters, latency histograms and gauges of this process.
+
+    The download server keeps its own, the fuse process asks for them
+    with a DownloadStatsRequest and renders both in the Prometheus text
+    format, every sample labeled with the process it comes from.
+    """
+    # name --> (type, help)
+    METRICS = dict(
+        dropbox_fuse_op_seconds=('histogram', 'Latency of fuse operations'),
+        dropbox_fuse_op_errors_total=('counter', 'Fuse operations that failed, by errno'),
+        dropbox_metadata_cache_requests_total=('counter', 'Metadata cache lookups by result'),
+        dropbox_metadata_cache_removals_total=('counter', 'Metadata cache entries removed'),
+        dropbox_metadata_cache_entries=('gauge', 'Entries in the metadata cache'),
+        dropbox_data_cache_requests_total=('counter', 'Data cache lookups by result'),
+        dropbox_data_cache_evictions_total=('counter', 'Data cache entries evicted'),
+        dropbox_data_cache_evicted_bytes_total=('counter', 'Bytes evicted from the data cache'),
+        dropbox_data_cache_bytes=('gauge', 'Bytes held by the data cache'),
+        dropbox_block_store_hits_total=('counter', 'Blocks loaded from the block store'),
+        dropbox_read_requests_total=('counter', 'Stream reads by whether the data was cached'),
+        dropbox_remote_request_seconds=('histogram', 'Latency of Dropbox API calls until the response headers'),
+        dropbox_remote_errors_total=('counter', 'Dropbox API calls that failed'),
+        dropbox_downloaded_bytes_total=('counter', 'File data downloaded from Dropbox'),
+        dropbox_uploaded_bytes_total=('counter', 'File data uploaded to Dropbox'),
+        dropbox_active_streams=('gauge', 'Open download streams'),
+        dropbox_active_fetchers=('gauge', 'Ranged downloads in flight'),
+        dropbox_fetch_queue=('gauge', 'Ranged downloads waiting for a fetch worker'),
+        dropbox_cpu_seconds=('gauge', 'User and system CPU time of the process'),
+    )
+    lock = threading.Lock()
+    # (name, sorted label items) --> value, Histogram or gauge function
+    counters = dict()
+    histograms = dict()
+    gauges = dict()
+
+    @staticmethod
+    def _key(name, labels):
+        assert name in DropboxMetrics.METRICS, 'unknown metric %s' % (name, )
+        return name, tuple(sorted(labels.iteritems()))
+
+    @staticmethod
+    def inc(name, value=1, **labels):
+        key = DropboxMetrics._key(name, labels)
+        with DropboxMetrics.lock:
+            DropboxMetrics.counters[key] = DropboxMetrics.counters.get(key, 0) + value
+
+    @staticmethod
+    def observe(name, value, **labels):
+        key = DropboxMetrics._key(name, labels)
+        with DropboxMetrics.lock:
+            histogram = DropboxMetrics.histograms.get(key)
+            if histogram is None:
+                histogram = DropboxMetrics.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @staticmethod
+    def timer(name, **labels):
+        return _Timer(name, labels)
+
+    @staticmethod
+    def gauge(name, func, **labels):
+        # func is called whenever the metrics are collected
+        key = DropboxMetrics._key(name, labels)
+        with DropboxMetrics.lock:
+            DropboxMetrics.gauges[key] = func
+
+    @staticmethod
+    def reset():
+        # a forked process starts counting from scratch
+        DropboxMetrics.lock = threading.Lock()
+        DropboxMetrics.counters = dict()
+        DropboxMetrics.histograms = dict()
+        DropboxMetrics.gauges = dict()
+
+    @staticmethod
+    def collect():
+        # picklable copy of the current values
+        with DropboxMetrics.lock:
+            counters = dict(DropboxMetrics.counters)
+            histograms = dict((key, (h.buckets, list(h.counts), h.sum))
+                              for key, h in DropboxMetrics.histograms.iteritems())
+            gauges = dict(DropboxMetrics.gauges)
+        values = dict()
+        for key, func in gauges.iteritems():
+            values[key] = func()
+        return dict(counters=counters, histograms=histograms, gauges=values)
+
+    @staticmethod
+    def render(collected):
+        # collected maps a process name to what collect() returned there
+        samples = dict()
+        for process, metrics in sorted(collected.iteritems()):
+            for kind in ('counters', 'gauges', 'histograms'):
+                for (name, labels), value in metrics[kind].iteritems():
+                    labels = labels + (('process', process), )
+                    samples.setdefault(name, list()).append((labels, value))
+
+        lines = list()
+        for name in sorted(samples):
+            kind, doc = DropboxMetrics.METRICS[name]
+            lines.append('# HELP %s %s' % (name, doc))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in sorted(samples[name]):
+                if kind != 'histogram':
+                    lines.append('%s%s %s' % (name, _labels(labels), _number(value)))
+                    continue
+                buckets, counts, total = value
+                cumulative = 0
+                for bound, count in zip(buckets + (float('inf'), ), counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else _number(bound)
+                    lines.append('%s_bucket%s %d' % (name, _labels(labels + (('le', le), )), cumulative))
+                lines.append('%s_sum%s %s' % (name, _labels(labels), _number(total)))
+                lines.append('%s_count%s %d' % (name, _labels(labels), cumulative))
+        return '\n'.join(lines) + '\n'
+
+
+class _Timer(object):
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, typ, value, traceback):
+        DropboxMetrics.observe(self.name, time.time() - self.started, **self.labels)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                             for k, v in labels)
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
@@ -0,0 +1,82 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+
+import os
+import zlib
+import cPickle
+import threading
+
+import dropbox
+from dropbox_logger import DropboxLogManager
+
+
+class DropboxMetadataSnapshot(threading.Thread):
+    """
+    Saves the MetadataCache entries to a file and loads them on the next
+    mount, so lookups are answered from the snapshot while the snapshot
+    directories are revalidated against their hash in the background.
+    """
+    VERSION = 1
+
+    def __init__(self, mcache, path, interval=300):
+        self.logger = DropboxLogManager.get_logger(self)
+        self.mcache = mcache
+        self.path = path
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._save_lock = threading.Lock()
+        super(DropboxMetadataSnapshot, self).__init__()
+        self.daemon = True
+
+    def stop(self):
+        self._stop_event.set()
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            self.logger.info('no metadata snapshot at %s', self.path)
+            return
+
+        try:
+            with open(self.path, 'rb') as fp:
+                version, records = cPickle.loads(zlib.decompress(fp.read()))
+        except Exception as e:
+            self.logger.error('failed to load metadata snapshot %s: %s', self.path, str(e))
+            return
+
+        if version != DropboxMetadataSnapshot.VERSION:
+            self.logger.warn('metadata snapshot version %s, expected %d', version, DropboxMetadataSnapshot.VERSION)
+            return
+
+        self.mcache.load_snapshot(records)
+        self.logger.info('loaded %d entries from metadata snapshot', len(records))
+
+    def save(self):
+        with self._save_lock:
+            records = self.mcache.dump_snapshot()
+            data = zlib.compress(cPickle.dumps((DropboxMetadataSnapshot.VERSION, records), 2))
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'wb') as fp:
+                fp.write(data)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.rename(tmp_path, self.path)
+        self.logger.info('saved %d entries to metadata snapshot (%d bytes)', len(records), len(data))
+
+    def revalidate(self):
+        for lower_path in self.mcache.snapshot_directories():
+            if self._stop_event.is_set():
+                return
+            try:
+                self.mcache.revalidate(lower_path)
+            except (dropbox.rest.ErrorResponse, dropbox.rest.RESTSocketError) as e:
+                self.logger.error('failed to revalidate %s: %s', lower_path, str(e))
+        self.logger.info('metadata snapshot revalidated')
+
+    def run(self):
+        self.load()
+        self.revalidate()
+        while self.interval > 0 and not self._stop_event.wait(self.interval):
+            try:
+                self.save()
+            except (IOError, OSError) as e:
+                self.logger.error('failed to save metadata snapshot: %s', str(e))
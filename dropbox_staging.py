@@ -0,0 +1,105 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+
+from dropbox_logger import DropboxLogManager
+
+
+class DropboxStagingFile(object):
+    """
+    Local copy of a file that is written at random offsets.
+
+    The file is uploaded from here once it is closed, callers serialize
+    access through the uploader lock. The remote content an existing file
+    starts with is fetched block by block, only once it is needed.
+    """
+    BLOCK_SIZE = 1024 * 1024
+
+    def __init__(self, path, staging_dir=None):
+        self.logger = DropboxLogManager.get_logger(self)
+        self.path = path
+        fd, self.staging_path = tempfile.mkstemp(prefix='dropboxfuse-', dir=staging_dir)
+        self.fp = os.fdopen(fd, 'w+b')
+        self.size = 0
+        # the remote content still counts up to base_size, its blocks
+        # in missing are not fetched yet, fetch(offset, length) does it
+        self.base_size = 0
+        self.missing = set()
+        self.fetch = None
+        self.logger.info('%s: staging in %s', os.path.basename(self.path), self.staging_path)
+
+    def load(self, size, fetch):
+        # the file starts with the `size` bytes of remote content
+        self.fp.truncate(size)
+        self.size = size
+        self.base_size = size
+        self.missing = set(xrange((size + DropboxStagingFile.BLOCK_SIZE - 1) // DropboxStagingFile.BLOCK_SIZE))
+        self.fetch = fetch
+
+    def _load_block(self, index):
+        offset = index * DropboxStagingFile.BLOCK_SIZE
+        data = self.fetch(offset, min(DropboxStagingFile.BLOCK_SIZE, self.base_size - offset))
+        self.fp.seek(offset)
+        self.fp.write(data)
+        self.missing.discard(index)
+
+    def _blocks(self, offset, end):
+        # the missing blocks in [offset, end)
+        if not self.missing or end <= offset:
+            return []
+        first = offset // DropboxStagingFile.BLOCK_SIZE
+        last = (end - 1) // DropboxStagingFile.BLOCK_SIZE
+        return [index for index in xrange(first, last + 1) if index in self.missing]
+
+    def write(self, data, offset):
+        end = offset + len(data)
+        for index in self._blocks(offset, end):
+            block_start = index * DropboxStagingFile.BLOCK_SIZE
+            block_end = min(block_start + DropboxStagingFile.BLOCK_SIZE, self.base_size)
+            if offset <= block_start and end >= block_end:
+                # overwritten completely, the remote content is not needed
+                self.missing.discard(index)
+            else:
+                self._load_block(index)
+        self.fp.seek(offset)
+        self.fp.write(data)
+        self.size = max(self.size, end)
+
+    def read(self, size, offset):
+        if offset >= self.size:
+            return ''
+        size = min(size, self.size - offset)
+        for index in self._blocks(offset, offset + size):
+            self._load_block(index)
+        self.fp.seek(offset)
+        return self.fp.read(size)
+
+    def truncate(self, length):
+        if length < self.base_size:
+            self.base_size = length
+            self.missing = set(index for index in self.missing
+                               if index * DropboxStagingFile.BLOCK_SIZE < length)
+            # the part of the last block that is kept
+            for index in self._blocks(length - length % DropboxStagingFile.BLOCK_SIZE, length):
+                self._load_block(index)
+        self.fp.truncate(length)
+        self.size = length
+
+    def sync(self):
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+
+    def chunks(self, chunk_size):
+        offset = 0
+        while offset < self.size:
+            yield offset, self.read(chunk_size, offset)
+            offset += chunk_size
+
+    def close(self):
+        self.fp.close()
+        try:
+            os.unlink(self.staging_path)
+        except OSError as e:
+            self.logger.error('failed to remove %s: %s', self.staging_path, str(e))
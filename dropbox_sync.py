@@ -0,0 +1,72 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+
+import threading
+
+import dropbox
+from dropbox_logger import DropboxLogManager
+
+
+class DropboxDeltaSync(threading.Thread):
+    CURSOR_KEY = 'delta_cursor'
+    # longpoll_delta() accepts 30 to 480 seconds
+    MIN_LONGPOLL = 30
+    MAX_LONGPOLL = 480
+
+    def __init__(self, client, mcache, interval=60):
+        self.logger = DropboxLogManager.get_logger(self)
+        self.client = client
+        self.mcache = mcache
+        self.interval = interval
+        self._stop_event = threading.Event()
+        super(DropboxDeltaSync, self).__init__()
+        self.daemon = True
+
+    @property
+    def cursor(self):
+        return self.client.config.get(DropboxDeltaSync.CURSOR_KEY)
+
+    @cursor.setter
+    def cursor(self, value):
+        self.client.config[DropboxDeltaSync.CURSOR_KEY] = value
+        self.client.config.commit()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def sync(self):
+        if self.cursor is None:
+            # nothing is cached yet, whatever we fetch from now on is fresh
+            self.cursor = self.client.delta_latest_cursor()
+            self.logger.info('starting delta sync from the latest cursor')
+            return
+
+        has_more = True
+        while has_more and not self._stop_event.is_set():
+            delta = self.client.delta(cursor=self.cursor)
+            self.logger.info('got %d delta entries (reset %s)', len(delta['entries']), delta['reset'])
+            self.mcache.apply_delta(delta['entries'], reset=delta['reset'])
+            self.cursor = delta['cursor']
+            has_more = delta['has_more']
+
+    def wait(self):
+        timeout = min(max(self.interval, DropboxDeltaSync.MIN_LONGPOLL), DropboxDeltaSync.MAX_LONGPOLL)
+        try:
+            res = self.client.longpoll_delta(self.cursor, timeout=timeout)
+        except (dropbox.rest.ErrorResponse, dropbox.rest.RESTSocketError) as e:
+            self.logger.warn('longpoll_delta failed: %s', str(e))
+            self._stop_event.wait(self.interval)
+            return
+
+        if 'backoff' in res:
+            self._stop_event.wait(res['backoff'])
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.sync()
+            except (dropbox.rest.ErrorResponse, dropbox.rest.RESTSocketError) as e:
+                self.logger.error('delta sync failed: %s', str(e))
+                self._stop_event.wait(self.interval)
+                continue
+            self.wait()
@@ -3,15 +3,26 @@
 
 import cStringIO
 import os
+import threading
 
 import dropbox
 from dropbox_exceptions import UploadError
 from dropbox_cache import MetadataCacheEntry
 from dropbox_logger import DropboxLogManager
+from dropbox_metrics import DropboxMetrics
+from dropbox_staging import DropboxStagingFile
 
 
 class DropboxUploader(object):
-    def __init__(self, path, client, overwrite=False):
+    # default size of the chunks sent to chunked_upload
+    CHUNK_SIZE = 8 * 1024 * 1024
+    # chunks a write-back uploader may hold before write() waits
+    MAX_PENDING = 2
+    # counters of all uploaders, see stats()
+    totals = dict(writes=0, bytes_written=0, chunks_uploaded=0, bytes_uploaded=0, commits=0)
+    totals_lock = threading.Lock()
+
+    def __init__(self, path, client, overwrite=False, chunk_size=None, writeback=None, staging_dir=None):
         self.logger = DropboxLogManager.get_logger(self)
         self.path = path
         self.client = client
@@ -19,37 +30,330 @@ class DropboxUploader(object):
         self.expected_offset = 0
         self.overwrite = overwrite
         self.expires = None
+        self.chunk_size = chunk_size if chunk_size is not None else DropboxUploader.CHUNK_SIZE
+        # end of the data handed to write()
+        self.written = 0
+        # writes not uploaded yet
+        self.buffer = list()
+        self.buffered = 0
+        self.counters = dict(writes=0, bytes_written=0, chunks_uploaded=0, bytes_uploaded=0, commits=0)
+        # write-back state: chunks waiting for a worker, the callback of
+        # a pending commit and the error that ended the upload
+        self.writeback = writeback
+        self.pending = list()
+        self.scheduled = False
+        self.callback = None
+        self.committing = False
+        # set once the commit landed or failed, see wait_finished()
+        self.finished = False
+        self.error = None
+        # local copy of the file once it is not written sequentially
+        self.staging_dir = staging_dir
+        self.staging = None
+        # rev of the remote content an opened file starts with, the parts
+        # of it a staged file needs are downloaded by range
+        self.base = None
+        # False until an opened file is written or truncated
+        self.dirty = True
+        # chunks of the same file are uploaded one at a time
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+
+    def _count(self, **counts):
+        with DropboxUploader.totals_lock:
+            for name, value in counts.iteritems():
+                self.counters[name] += value
+                DropboxUploader.totals[name] += value
+
+    @staticmethod
+    def stats():
+        with DropboxUploader.totals_lock:
+            return dict(DropboxUploader.totals)
+
+    @property
+    def size(self):
+        return self.written
+
+    def open_existing(self, size, rev):
+        with self.lock:
+            self.base = rev
+            self.written = size
+            self.dirty = False
+
+    def _check_open(self):
+        if self.error is not None:
+            raise self.error
+        if self.committing:
+            msg = '%s: the file is being committed' % (self.path, )
+            self.logger.error(msg)
+            raise UploadError(msg)
+
+    def write(self, data, offset):
+        with self.lock:
+            self._check_open()
+
+            self._count(writes=1, bytes_written=len(data))
+            self.dirty = True
+            if self.staging is None and (offset < self.written or self.base is not None):
+                self._stage()
+            if self.staging is not None:
+                self.staging.write(data, offset)
+                self.written = self.staging.size
+                return
+
+            # a hole, keep the upload sequential
+            self._pad(offset)
+            self._append(data)
+
+    def read(self, size, offset):
+        # None once the file is being committed, it is read from dropbox then
+        with self.lock:
+            if self.committing:
+                return None
+            if self.staging is None:
+                self._stage()
+            return self.staging.read(size, offset)
+
+    def truncate(self, length):
+        with self.lock:
+            self._check_open()
+            self.dirty = True
+            if self.staging is None and self.base is not None and length == 0:
+                # the remote content is not needed after all
+                self.base = None
+                self.written = 0
+                return
+            if self.staging is None and self.base is None and length >= self.written:
+                self._pad(length)
+                return
+            if self.staging is None:
+                self._stage()
+            self.staging.truncate(length)
+            self.written = length
+
+    def _stage(self):
+        # move to a staging file seeded with the remote content or
+        # what was written so far
+        if self.staging is not None:
+            return
+        if self.upload_id is not None or self.pending:
+            msg = '%s: can not write at random offsets, the first %d bytes are uploaded already' % (
+                self.path, self.expected_offset)
+            self.logger.error(msg)
+            raise UploadError(msg)
+
+        staging = DropboxStagingFile(self.path, self.staging_dir)
+        if self.base is not None:
+            # fetched by range when a part of it is needed
+            staging.load(self.written, self._fetch_base)
+        if self.buffer:
+            staging.write(''.join(self.buffer), 0)
+            self.buffer = list()
+            self.buffered = 0
+        self.staging = staging
+        self.written = staging.size
+
+    def _fetch_base(self, offset, length):
+        # a range of the remote content the file was opened with
+        try:
+            fp = self.client.get_file(self.path, rev=self.base, start=offset, length=length)
+            try:
+                data = fp.read()
+            finally:
+                fp.close()
+        except (dropbox.rest.ErrorResponse, dropbox.rest.RESTSocketError, IOError) as e:
+            self.logger.error('get_file error: %s', str(e))
+            raise UploadError(str(e))
+        if len(data) != length:
+            msg = '%s: short read of the remote content at %d: %d != %d' % (self.path, offset, len(data), length)
+            self.logger.error(msg)
+            raise UploadError(msg)
+        return data
+
+    def discard(self):
+        with self.lock:
+            self._discard_staging()
+
+    def _discard_staging(self):
+        if self.staging is not None:
+            self.staging.close()
+            self.staging = None
+
+    def _pad(self, offset):
+        while self.written < offset:
+            self._append('\0' * min(offset - self.written, self.chunk_size))
+
+    def _append(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        self.written += len(data)
+        if self.buffered >= self.chunk_size:
+            self._flush()
 
     def upload_chunk(self, chunk, offset):
-        self.logger.info('%s: upload chunk len %d offset %d', self.path, len(chunk), offset)
-        assert offset == self.expected_offset, 'out of order chunk upload'
+        self.write(chunk, offset)
+        self.sync()
 
-        self.logger.info('%s: uploaded %d KB' % (
-            os.path.basename(self.path),
-            offset / 1024)
-        )
+    def sync(self):
+        # returns once everything written so far is uploaded,
+        # or is on local disk for a staged file
+        with self.lock:
+            if self.staging is not None:
+                self.staging.sync()
+                return
+            self._flush()
+            self._wait()
+
+    def _flush(self):
+        if not self.buffer:
+            return
+        chunk = ''.join(self.buffer)
+        offset = self.written - self.buffered
+
+        if self.writeback is None:
+            # the chunk is kept until it is uploaded
+            try:
+                self._upload_chunk(chunk, offset)
+            except UploadError as e:
+                self.error = e
+                raise
+            self.buffer = list()
+            self.buffered = 0
+            return
+
+        self.buffer = list()
+        self.buffered = 0
+        self.pending.append((chunk, offset))
+        self._schedule()
+        while len(self.pending) > DropboxUploader.MAX_PENDING and self.error is None:
+            self.idle.wait()
+
+    def _wait(self):
+        while self.scheduled:
+            self.idle.wait()
+        if self.error is not None:
+            raise self.error
+
+    def _schedule(self):
+        if not self.scheduled:
+            self.scheduled = True
+            self.writeback.submit(self._drain)
+
+    def _drain(self):
+        # runs on a write-back worker, at most one per uploader
+        while True:
+            chunk = None
+            with self.lock:
+                if self.pending and self.error is None:
+                    chunk, offset = self.pending.pop(0)
+                    self.idle.notify_all()
+                elif self.callback is None:
+                    self.pending = list()
+                    self.scheduled = False
+                    self.idle.notify_all()
+                    return
+                else:
+                    callback = self.callback
+                    self.callback = None
+
+            if chunk is not None:
+                try:
+                    self._upload_chunk(chunk, offset)
+                except UploadError as e:
+                    with self.lock:
+                        self.error = e
+                continue
+
+            entry, error = None, self.error
+            if error is not None:
+                self._discard_staging()
+            else:
+                try:
+                    entry = self._commit()
+                except UploadError as e:
+                    error = e
+                    with self.lock:
+                        self.error = e
+            try:
+                callback(self, entry, error)
+            finally:
+                self.finish()
+
+    def finish(self):
+        # the cache has the committed entry, or none after an error
+        with self.lock:
+            self.finished = True
+            self.idle.notify_all()
+
+    def wait_finished(self):
+        with self.lock:
+            while not self.finished:
+                self.idle.wait()
+
+    def _upload_chunk(self, chunk, offset):
+        self.logger.info('%s: upload chunk len %d offset %d', self.path, len(chunk), offset)
+        if offset != self.expected_offset:
+            msg = '%s: out of order chunk upload at %d, expected %d' % (self.path, offset, self.expected_offset)
+            self.logger.error(msg)
+            raise UploadError(msg)
 
         fp = cStringIO.StringIO(chunk)
         try:
             res = self.client.upload_chunk(fp, offset=offset, upload_id=self.upload_id)
-        except dropbox.rest.ErrorResponse as e:
+        except (dropbox.rest.ErrorResponse, dropbox.rest.RESTSocketError) as e:
             self.logger.error('upload_chunk error: %s', str(e))
-            raise UploadError(e)
+            raise UploadError(str(e))
 
         self.expected_offset = res[0]
         self.upload_id = res[1]
+        self._count(chunks_uploaded=1, bytes_uploaded=len(chunk))
+        DropboxMetrics.inc('dropbox_uploaded_bytes_total', len(chunk))
+        self.logger.info('%s: uploaded %d KB' % (
+            os.path.basename(self.path),
+            self.expected_offset / 1024)
+        )
 
     def commit(self):
+        with self.lock:
+            self.committing = True
+            self._flush()
+            self._wait()
+            return self._commit()
+
+    def commit_later(self, callback):
+        # commits on a write-back worker once the pending chunks are
+        # uploaded, callback(uploader, cache_entry, error) runs there too
+        with self.lock:
+            if self.committing:
+                return
+            self.committing = True
+            self._flush()
+            self.callback = callback
+            self._schedule()
+
+    def _commit(self):
         #TODO: maybe add the data to the cache too??
         self.logger.info('%s: commit upload (id %s)',
                          os.path.basename(self.path),
                          self.upload_id)
-        assert self.upload_id is not None, 'upload_id should not be None when commiting'
+        try:
+            if self.staging is not None:
+                for offset, chunk in self.staging.chunks(self.chunk_size):
+                    self._upload_chunk(chunk, offset)
+        finally:
+            self._discard_staging()
+
+        if self.upload_id is None:
+            # nothing was written, start an empty upload
+            self._upload_chunk('', 0)
 
         try:
             full_path = os.path.normpath('/dropbox/%s' % self.path)
             res = self.client.commit_chunked_upload(full_path, self.upload_id, overwrite=self.overwrite)
-        except dropbox.rest.ErrorResponse as e:
+        except (dropbox.rest.ErrorResponse, dropbox.rest.RESTSocketError) as e:
             self.logger.error('commit_chunked_upload error: %s', str(e))
             raise UploadError(str(e))
+        self._count(commits=1)
+        self.logger.info('%s: %d writes in %d chunks', os.path.basename(self.path),
+                         self.counters['writes'], self.counters['chunks_uploaded'])
         return MetadataCacheEntry(self.path, self.client, metadata=res)
@@ -2,7 +2,9 @@
 # -*- coding: utf-8 -*-
 
 import os
+import bisect
 import fcntl
+import hashlib
 
 
 class FileDescriptor(object):
@@ -65,3 +67,41 @@ class FakeFileObject(object):
             self._wpipe.write('shit')
         else:
             self._rpipe.read(FakeFileObject.BUFFER_SIZE)
+
+
+def compact_string(value):
+    # ascii unicode takes four times the memory of a str, equal
+    # interned strs are shared by the cache keys and entries
+    if isinstance(value, unicode):
+        try:
+            value = value.encode('ascii')
+        except UnicodeError:
+            return value
+    if isinstance(value, str):
+        return intern(value)
+    return value
+
+
+class HashRing(object):
+    """
+    Consistent hash of keys to nodes 0 to nodes - 1, every node owns
+    `replicas` points on the ring and a key goes to the node owning the
+    first point after the hash of the key.
+    """
+    REPLICAS = 64
+
+    def __init__(self, nodes, replicas=REPLICAS):
+        points = sorted((HashRing.hash('%d-%d' % (node, replica)), node)
+                        for node in xrange(nodes) for replica in xrange(replicas))
+        self.points = [point for point, node in points]
+        self.nodes = [node for point, node in points]
+
+    @staticmethod
+    def hash(key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+    def get(self, key):
+        index = bisect.bisect(self.points, HashRing.hash(key))
+        return self.nodes[index % len(self.nodes)]
@@ -0,0 +1,54 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+
+import Queue
+import threading
+
+from dropbox_logger import DropboxLogManager
+
+
+class DropboxWriteBackWorker(threading.Thread):
+    def __init__(self, queue):
+        self.logger = DropboxLogManager.get_logger(self)
+        self.queue = queue
+        super(DropboxWriteBackWorker, self).__init__()
+        self.daemon = True
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                job()
+            except Exception as e:
+                self.logger.exception('write-back job failed: %s', str(e))
+            finally:
+                self.queue.task_done()
+
+
+class DropboxWriteBack(object):
+    """
+    Worker pool that runs uploads and commits in the background.
+
+    Jobs go through a bounded queue, once it is full submit() blocks the
+    fuse thread that writes until a worker catches up.
+    """
+    def __init__(self, workers=4, queue_size=64):
+        self.logger = DropboxLogManager.get_logger(self)
+        self.queue = Queue.Queue(maxsize=queue_size)
+        self.workers = [DropboxWriteBackWorker(self.queue) for i in xrange(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, job):
+        self.queue.put(job)
+
+    def shutdown(self):
+        # let the pending uploads land before the workers go away
+        self.logger.info('waiting for %d write-back jobs', self.queue.qsize())
+        self.queue.join()
+        for worker in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
@@ -8,7 +8,7 @@ import sys
 import os
 from dropbox_logger import DropboxLogManager
 from dropbox_client import DropboxClient
-from dropbox_cache import CacheManager, MetadataCache
+from dropbox_cache import CacheManager, MetadataCache, DataCache, DataCacheEntry
 from dropbox_download_manager import DropboxDownloadManager
 
 
@@ -26,11 +26,31 @@ def download_file(download_manager, filename):
     return buf
 
 
+def test_data_cache_budget():
+    # entries in use stay cached over the budget and do not get
+    # a new entry evicted as soon as it is added
+    block = DataCacheEntry.BLOCK_SIZE
+    dcache = DataCache(None, max_bytes=block)
+    for path in ('/a', '/b'):
+        entry = dcache.get_entry(path, size=block, acquire=True)
+        entry.set_block(0, '\0' * block)
+    assert dcache.bytes_held > dcache.max_bytes
+
+    entry = dcache.get_entry('/c', size=block, acquire=True)
+    assert dcache.cache.get('/c') is entry and entry.owner is dcache
+
+    for path in ('/a', '/b', '/c'):
+        dcache.release(dcache.cache[path])
+    assert dcache.bytes_held <= dcache.max_bytes
+
+
 def main():
+    test_data_cache_budget()
     config_file = os.path.join(os.getenv('HOME'), '.dropboxfuse')
     log = DropboxLogManager()
     client = DropboxClient(config_file)
     CacheManager.set_cache('MetadataCache', MetadataCache(client))
+    CacheManager.set_cache('DataCache', DataCache(client))
     download_manager = DropboxDownloadManager(client)
     print download_file(download_manager, '/hello.txt')
 